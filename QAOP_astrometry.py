@@ -0,0 +1,168 @@
+#This module does the plate solving uploads and downloads from the AstrometryNotebook, but keeps track of every file in a
+# ledger on disk instead of in the nameSubs/names variables. Each time a file moves on a step
+#    uploaded (has a subid) -> solving (has a jobid) -> solved -> downloaded   (or failed)
+# a line is added to the ledger file, so if the kernel is restarted (or the computer goes to sleep) nothing is lost:
+# running it again skips the files that are already uploaded and only polls the jobs that haven't finished.
+#
+#The usual way to use it is:
+#    cAPI = client.Client(); cAPI.login(APIKEY)
+#    ledger = jobLedger(dataFilePath+'astrometry_ledger.jsonl')
+#    solveFiles(cAPI, ledger, [dataFilePath+'input/'+fn for fn in inputFiles], dataFilePath+'output/')
+#
+#All of the jobs are checked together in one loop. Whenever a round of checks finds nothing new, the wait before the next
+# round doubles (up to maxDelay), and it goes back to the start as soon as something changes.
+
+import os
+import json
+import time
+from http.client import HTTPException
+from urllib.request import urlopen
+
+try:
+    from client import RequestError, MalformedResponse
+except ModuleNotFoundError:
+    from QAOP.client import RequestError, MalformedResponse
+
+#The order the states go in; a file is finished once it is downloaded or failed
+STATES = ['uploaded','solving','solved','downloaded','failed']
+FINISHED = ('downloaded','failed')
+#The errors a check can hit that might go away if it is tried again (a dropped connection, a timeout, an error message from the server)
+RETRYABLE = (OSError,HTTPException,RequestError,MalformedResponse)
+
+
+class jobLedger:
+    '''The state of every file being plate solved, kept in a JSON lines file at "path". Each line is one update to one file (ie, {"file": ..., "state": "solving", "jobid": 123}), and reading the file back replays them, so the ledger is never rewritten in place and a crash can at worst lose the line being written.
+    entries is a dictionary of each file's current state and ids.'''
+
+    def __init__(self,path):
+        self.path = path
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path) as ledgerFile:
+                for line in ledgerFile:
+                    try:
+                        update = json.loads(line)
+                    except ValueError: #ie, a half written last line from a crash
+                        continue
+                    self.entries.setdefault(update['file'],{}).update(update)
+
+    def record(self,filepath,state,**fields):
+        '''Moves a file on to a new state (with any new ids, ie subid= or jobid=), and appends it to the ledger file straight away.'''
+        if state not in STATES: raise ValueError("Unknown state "+repr(state)+", it should be one of "+str(STATES))
+        update = dict(fields,file=filepath,state=state,time=time.time())
+        self.entries.setdefault(filepath,{}).update(update)
+        with open(self.path,'a') as ledgerFile:
+            ledgerFile.write(json.dumps(update)+'\n')
+            ledgerFile.flush()
+            os.fsync(ledgerFile.fileno())
+        return self.entries[filepath]
+
+    def state(self,filepath):
+        return self.entries.get(filepath,{}).get('state')
+
+    def inState(self,*states):
+        return [filepath for filepath,entry in self.entries.items() if entry.get('state') in states]
+
+    def unfinished(self):
+        return [filepath for filepath,entry in self.entries.items() if entry.get('state') not in FINISHED]
+
+    def summary(self):
+        #how many files are in each state
+        counts = {state:0 for state in STATES}
+        for entry in self.entries.values(): counts[entry['state']] += 1
+        return counts
+
+    def compact(self):
+        '''Rewrites the ledger file with just one line per file (its current state). It is written to a new file which then replaces the old one, so the ledger is never left half written.'''
+        with open(self.path+'.tmp','w') as ledgerFile:
+            for entry in self.entries.values(): ledgerFile.write(json.dumps(entry)+'\n')
+        os.replace(self.path+'.tmp',self.path)
+
+
+def outputName(filepath,outputDir):
+    #the notebook's naming: 009.fit -> 009.fits in the output folder
+    name = os.path.basename(filepath)
+    for ext in ['.fits','.fit']:
+        if name.endswith(ext):
+            name = name[:-len(ext)]
+            break
+    return os.path.join(outputDir,name+'.fits')
+
+def downloadNewFits(client,jobid,outpath,timeout=60):
+    '''Downloads the new-image.fits (the original frame with the WCS added to the header) for a solved job. It is written to a temporary file first and then moved into place, so a frame in the output folder is always complete.
+    A connection that stalls for "timeout" seconds raises an OSError, so pollJobs() tries it again later instead of waiting forever.'''
+    url = client.apiurl.replace('/api/','/new_fits_file/%i/' % int(jobid))
+    with urlopen(url,timeout=timeout) as response:
+        data = response.read()
+    with open(outpath+'.part','wb') as out: out.write(data)
+    os.replace(outpath+'.part',outpath)
+    return outpath
+
+def uploadFiles(client,ledger,filepaths,**uploadArgs):
+    '''Uploads each of the files that isn't in the ledger yet, recording its submission id. Files that were already uploaded (ie, before a restart) are skipped. Returns the number uploaded.'''
+    uploaded = 0
+    for filepath in filepaths:
+        if ledger.state(filepath) is not None: continue
+        result = client.upload(filepath,**uploadArgs)
+        if not result or result.get('status') != 'success':
+            print('Upload of',filepath,'failed:',result)
+            continue
+        ledger.record(filepath,'uploaded',subid=result['subid'])
+        uploaded += 1
+    return uploaded
+
+def checkJob(client,ledger,filepath,outputDir,download=downloadNewFits):
+    '''Moves one unfinished file on as far as it can go right now, and returns True if its state changed.'''
+    entry = ledger.entries[filepath]
+    before = entry['state']
+    if entry['state'] == 'uploaded':
+        result = client.sub_status(entry['subid'],justdict=True) or {}
+        jobs = [job for job in result.get('jobs',[]) if job is not None]
+        if jobs: ledger.record(filepath,'solving',jobid=jobs[0])
+    if entry['state'] == 'solving':
+        status = (client.job_status(entry['jobid'],justdict=True) or {}).get('status')
+        if status == 'success': ledger.record(filepath,'solved')
+        elif status == 'failure': ledger.record(filepath,'failed')
+    if entry['state'] == 'solved':
+        outpath = download(client,entry['jobid'],outputName(filepath,outputDir))
+        ledger.record(filepath,'downloaded',output=outpath)
+    return entry['state'] != before
+
+def pollJobs(client,ledger,outputDir,startDelay=2.0,maxDelay=120.0,factor=2.0,timeout=None,maxErrors=5,download=downloadNewFits,sleep=time.sleep,quiet=False):
+    '''Checks every unfinished file in the ledger, over and over, until they are all downloaded or failed (or "timeout" seconds pass). Between rounds it waits startDelay seconds, doubling (by "factor") each round that nothing changes, up to maxDelay.
+    A request that goes wrong (ie, the connection drops) only skips that file for the round, but a file whose checks go wrong maxErrors rounds in a row is marked failed. Any other error (ie, a ledger entry missing its jobid) will not fix itself, so the file is marked failed straight away. Returns the ledger's summary().'''
+    os.makedirs(outputDir,exist_ok=True)
+    start = time.monotonic()
+    delay = startDelay
+    errors = {} #how many checks in a row have gone wrong for each file
+    while True:
+        changed = False
+        for filepath in ledger.unfinished():
+            try:
+                changed |= checkJob(client,ledger,filepath,outputDir,download=download)
+                errors.pop(filepath,None)
+            except RETRYABLE as e:
+                errors[filepath] = errors.get(filepath,0) + 1
+                if errors[filepath] < maxErrors:
+                    if not quiet: print('Checking',filepath,'failed, it will be tried again:',e)
+                    continue
+                if not quiet: print('Checking',filepath,'failed',errors[filepath],'times in a row, giving up on it:',e)
+                ledger.record(filepath,'failed',error=repr(e))
+                changed = True
+            except Exception as e:
+                if not quiet: print('Checking',filepath,'failed, giving up on it:',repr(e))
+                ledger.record(filepath,'failed',error=repr(e))
+                changed = True
+        remaining = len(ledger.unfinished())
+        if not quiet: print('Astrometry:',ledger.summary())
+        if remaining == 0: break
+        if timeout is not None and time.monotonic() - start + delay > timeout: break
+        if changed: delay = startDelay
+        sleep(delay)
+        delay = min(delay*factor,maxDelay)
+    return ledger.summary()
+
+def solveFiles(client,ledger,filepaths,outputDir,uploadArgs={},**pollArgs):
+    '''Uploads any of the files that haven't been yet, then polls until every file in the ledger has been solved and downloaded into outputDir (or has failed). Can be stopped and run again at any point.'''
+    uploadFiles(client,ledger,filepaths,**uploadArgs)
+    return pollJobs(client,ledger,outputDir,**pollArgs)
@@ -0,0 +1,195 @@
+#This module is a benchmark suite for the slow parts of the project: reading frames, doing the photometry, adding rows to
+# the master table, the transit models, and how long the modules take to import. It makes its own synthetic frames with
+# QAOP_synthetic (the same generator used for load testing), so it can be run anywhere without any real data:
+#
+#    python QAOP_benchmark.py --out bench.json
+#    python QAOP_benchmark.py --out new.json --compare bench.json
+#
+#Each benchmark reports how long it took, its throughput (things per second), and the peak memory python allocated
+# while running it. The results are saved as JSON so that runs from different versions of the code can be compared.
+
+import os
+import sys
+import json
+import time
+import platform
+import tempfile
+import tracemalloc
+import numpy as np
+
+try:
+    from QAOP_synthetic import makeField, generateFrames, writeApertureFile
+except ModuleNotFoundError:
+    from QAOP.QAOP_synthetic import makeField, generateFrames, writeApertureFile
+
+
+def timeIt(function,count=1,repeat=3,unit='items'):
+    '''Runs function() "repeat" times, and returns a result dictionary with the best and median wall time, the throughput (count/best time, in "unit" per second) and the peak memory of the first run (in MB).
+    The first run is done with tracemalloc on to measure the memory, and isn't used for the timing since tracing slows things down.'''
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    times = []
+    for r in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter()-start)
+    best = min(times)
+    return {'best_s':best,'median_s':float(np.median(times)),'count':count,'unit':unit,
+            'throughput':count/best if best > 0 else float('inf'),'peak_mem_MB':peak/1e6}
+
+def benchPhotometry(shape=(2048,2048),nstars=50,nframes=10,repeat=3):
+    '''Benchmarks loadImageAndWCS(), doForApertures() and photInstance.runForFile() on synthetic frames, and loadFrame() and runForFile() on unsigned 16 bit ones. For runForFile the time of every call is kept, so that the growth of addRowToMaster() (which rewrites the whole table) with the number of rows shows up.'''
+    try:
+        import QAOP_photometry as phot
+    except ModuleNotFoundError:
+        import QAOP.QAOP_photometry as phot
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        field = makeField(nstars=nstars,shape=shape,seed=0)
+        filepaths = generateFrames(directory,field,nframes=nframes,apertureFile=None,truthFile=None)
+        writeApertureFile(os.path.join(directory,'apertures.csv'),field)
+        frameMB = os.path.getsize(filepaths[0])/1e6
+
+        results['loadImageAndWCS'] = timeIt(lambda: [phot.loadImageAndWCS(fp)[0].sum() for fp in filepaths],count=nframes,repeat=repeat,unit='frames')
+        results['loadImageAndWCS']['MB_per_s'] = results['loadImageAndWCS']['throughput']*frameMB
+
+        names,apertures,annuli = phot.loadAperturesFromFile(os.path.join(directory,'apertures.csv'))
+        image,wcs,img_time = phot.loadImageAndWCS(filepaths[0])
+        results['doForApertures'] = timeIt(lambda: phot.doForApertures(image,names,apertures,annuli,wcs),count=nstars,repeat=repeat,unit='stars')
+
+        resultDir = os.path.join(directory,'photometry')
+        os.mkdir(resultDir)
+        inst = phot.photInstance(os.path.join(directory,'apertures.csv'),resultDir,disableConfig=True)
+        tracemalloc.start()
+        perFrame = []
+        for filepath in filepaths:
+            start = time.perf_counter()
+            inst.runForFile(filepath)
+            perFrame.append(time.perf_counter()-start)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        #fit a line to the time per frame against the number of rows already in the table, to see how addRowToMaster grows
+        slope = float(np.polyfit(np.arange(nframes),perFrame,1)[0]) if nframes > 1 else 0.0
+        results['runForFile'] = {'best_s':min(perFrame),'median_s':float(np.median(perFrame)),'count':nframes,'unit':'frames',
+                                 'throughput':nframes/sum(perFrame),'peak_mem_MB':peak/1e6,
+                                 'per_frame_s':perFrame,'growth_s_per_row':slope}
+
+        #raw CCD frames are unsigned 16 bit (BITPIX=16 with BZERO=32768), which astropy has to scale as it reads them
+        rawPaths = generateFrames(os.path.join(directory,'uint16'),field,nframes=nframes,dtype=np.uint16,apertureFile=None,truthFile=None)
+        results['loadFrame_uint16'] = timeIt(lambda: [phot.loadFrame(fp)[0].sum() for fp in rawPaths],count=nframes,repeat=repeat,unit='frames')
+        results['loadFrame_uint16_stats'] = timeIt(lambda: [phot.loadFrame(fp,stats=phot.photStats())[0].sum() for fp in rawPaths],count=nframes,repeat=repeat,unit='frames')
+        rawDir = os.path.join(directory,'photometry_uint16')
+        os.mkdir(rawDir)
+        rawInst = phot.photInstance(os.path.join(directory,'apertures.csv'),rawDir,disableConfig=True)
+        tracemalloc.start()
+        start = time.perf_counter()
+        for filepath in rawPaths: rawInst.runForFile(filepath)
+        elapsed = time.perf_counter()-start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        results['runForFile_uint16'] = {'best_s':elapsed,'median_s':elapsed,'count':nframes,'unit':'frames','throughput':nframes/elapsed,'peak_mem_MB':peak/1e6}
+    return results
+
+def benchModels(npoints=1000,repeat=3):
+    '''Benchmarks the transit models in limbDark and exoModels over arrays of npoints times.'''
+    try:
+        import limbDark
+        import exoModels
+    except ModuleNotFoundError:
+        from QAOP import limbDark, exoModels
+    results = {}
+    z = np.linspace(1e-3,1.5,npoints) #z=0 divides by zero in transFlux
+    times = np.linspace(-1,1,npoints)
+    results['limbDark.transFluxArr'] = timeIt(lambda: limbDark.transFluxArr(z,p=0.1),count=npoints,repeat=repeat,unit='points')
+    results['exoModels.boxDipArr'] = timeIt(lambda: exoModels.boxDipArr(times,0.99,0.5,0.0),count=npoints,repeat=repeat,unit='points')
+    results['exoModels.trapDipArr'] = timeIt(lambda: exoModels.trapDipArr(times,0.99,0.5,0.1,0.0),count=npoints,repeat=repeat,unit='points')
+    results['exoModels.limbDarkArr'] = timeIt(lambda: exoModels.limbDarkArr(times,0.99,1.0,0.0),count=npoints,repeat=repeat,unit='points')
+    return results
+
+#The modules whose import time is benchmarked by benchStartup(); a script (or the notebooks) pays this every time it starts
+startupModules = ['QAOP_utils','QAOP_starID','QAOP_calibration','QAOP_photometry','QAOP_pipeline','exoModels']
+
+def benchStartup(modules=startupModules,repeat=3):
+    '''Benchmarks how long a fresh python takes to import each module (so nothing is already loaded, as when a script starts), along with the peak memory allocated by the import.
+    Each import is done in its own subprocess, and the time of a subprocess that only starts python is taken off.'''
+    import subprocess
+    directory = os.path.dirname(os.path.abspath(__file__))
+    def run(code):
+        start = time.perf_counter()
+        output = subprocess.run([sys.executable,'-c',code],cwd=directory,capture_output=True,text=True,check=True).stdout
+        return time.perf_counter()-start, output
+    baseline = min(run('pass')[0] for r in range(repeat))
+    results = {}
+    for module in modules:
+        peak = int(run('import tracemalloc; tracemalloc.start(); import {}; print(tracemalloc.get_traced_memory()[1])'.format(module))[1])
+        times = [max(run('import '+module)[0]-baseline,0.0) for r in range(repeat)]
+        best = min(times)
+        results['import '+module] = {'best_s':best,'median_s':float(np.median(times)),'count':1,'unit':'imports',
+                                     'throughput':1/best if best > 0 else float('inf'),'peak_mem_MB':peak/1e6}
+    return results
+
+def environment():
+    info = {'python':platform.python_version(),'platform':platform.platform(),'numpy':np.__version__,
+            'time':str(np.datetime64('now'))}
+    for package in ['astropy','photutils','scipy']:
+        try:
+            info[package] = __import__(package).__version__
+        except ImportError:
+            info[package] = None
+    return info
+
+def runBenchmarks(shape=(2048,2048),nstars=50,nframes=10,npoints=1000,repeat=3):
+    '''Runs all of the benchmarks and returns a dictionary of the results, along with the settings and the environment they were run in. If a group of benchmarks can't be run (ie, a package is missing), its error is recorded instead.'''
+    report = {'settings':{'shape':list(shape),'nstars':nstars,'nframes':nframes,'npoints':npoints,'repeat':repeat},
+              'environment':environment(),'results':{},'errors':{}}
+    for group,bench in [('startup',lambda: benchStartup(repeat=repeat)),
+                        ('photometry',lambda: benchPhotometry(shape,nstars,nframes,repeat)),
+                        ('models',lambda: benchModels(npoints,repeat))]:
+        try:
+            report['results'].update(bench())
+        except ImportError as e:
+            report['errors'][group] = repr(e)
+    return report
+
+def compareReports(new,old):
+    '''Returns a dictionary of new/old best time ratios for each benchmark that is in both reports (below 1 is faster).'''
+    ratios = {}
+    for name,result in new['results'].items():
+        if name in old['results'] and old['results'][name]['best_s'] > 0:
+            ratios[name] = result['best_s']/old['results'][name]['best_s']
+    return ratios
+
+def printReport(report,ratios=None):
+    for name,result in report['results'].items():
+        line = '{:28s} {:10.4f} s  {:12.1f} {}/s  {:9.1f} MB'.format(name,result['best_s'],result['throughput'],result['unit'],result['peak_mem_MB'])
+        if 'growth_s_per_row' in result: line += '  (+{:.2e} s per row)'.format(result['growth_s_per_row'])
+        if ratios and name in ratios: line += '  x{:.2f} vs old'.format(ratios[name])
+        print(line)
+    for group,error in report['errors'].items():
+        print(group,'skipped:',error)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Benchmark the QAOP photometry, model and I/O hot paths on synthetic data.')
+    parser.add_argument('--size',type=int,default=2048,help='Width and height of the synthetic frames in pixels')
+    parser.add_argument('--stars',type=int,default=50,help='Number of stars (and apertures) per frame')
+    parser.add_argument('--frames',type=int,default=10,help='Number of frames to write and reduce')
+    parser.add_argument('--points',type=int,default=1000,help='Number of points to evaluate the transit models at')
+    parser.add_argument('--repeat',type=int,default=3,help='Number of timed repeats (the best is reported)')
+    parser.add_argument('--out',help='Save the results as JSON to this file')
+    parser.add_argument('--compare',help='A previous JSON results file to compare against')
+    args = parser.parse_args()
+
+    report = runBenchmarks(shape=(args.size,args.size),nstars=args.stars,nframes=args.frames,npoints=args.points,repeat=args.repeat)
+    ratios = None
+    if args.compare:
+        with open(args.compare) as old:
+            ratios = compareReports(report,json.load(old))
+    printReport(report,ratios)
+    if args.out:
+        with open(args.out,'w') as out:
+            json.dump(report,out,indent=1)
+    sys.exit(0)
@@ -0,0 +1,177 @@
+#This module does the bias, dark and flat calibration of the frames. Rather than writing out a calibrated copy of every
+# frame (and then reading that back in again for the photometry), the master frames are made once and cached, and the
+# calibration is applied to each frame in memory as it is loaded by the photometry. In "cutout" mode it is only applied
+# to the boxes around the stars, since those are the only pixels the photometry looks at.
+#
+#The usual way to use it is:
+#    cal = calibrator.fromFiles(biasFiles, darkFiles, flatFiles, cacheDir=dataFilePath+'calibration/')
+#    inst = photInstance(calibration=cal)
+#
+#The master frames are median stacked a block of rows at a time, read straight from the files, so a stack of hundreds of
+# full frames never has to fit in memory all at once.
+
+import os
+import hashlib
+import numpy as np
+#astropy.io.fits is imported in the functions that read and write frames, so importing this module is quick
+
+
+def exposureTime(header,default=0.0):
+    for key in ['EXPTIME','EXPOSURE']:
+        if key in header: return float(header[key])
+    return default
+
+def medianStack(filepaths,rowsPerBlock=128,subtract=None,scales=None,normalise=False):
+    '''Median combines the frames in filepaths, reading them a block of rowsPerBlock rows at a time (through the HDU's section, which also scales unsigned 16 bit frames one block at a time), so only (number of files) x rowsPerBlock rows are ever in memory.
+    Before combining, "subtract" (a function of (header, row slice) returning an array to take off, ie the bias) is applied, and then each frame is divided by its entry in "scales". If normalise is True, each frame is instead divided by its own median (as for flats).'''
+    from astropy.io import fits
+    if not filepaths: raise ValueError("medianStack needs at least one file")
+    #.data would read (and scale) the whole frame, so the shape comes from the header and the pixels from .section
+    hduls = [fits.open(filepath) for filepath in filepaths]
+    try:
+        shape = hduls[0][0].shape
+        for filepath,hdul in zip(filepaths,hduls):
+            if hdul[0].shape != shape: raise ValueError("Frame "+filepath+" is "+str(hdul[0].shape)+", not "+str(shape))
+        factors = np.ones(len(hduls)) if scales is None else np.asarray(scales,dtype=float)
+        if normalise:
+            #each frame's own median is needed first; take it from a strided subsample so the whole frame isn't read twice
+            levels = []
+            for f,hdul in enumerate(hduls):
+                sample = np.asarray(hdul[0].section[::8,::8],dtype=float)
+                if subtract is not None: sample = sample - subtract(hdul[0].header,(slice(None,None,8),slice(None,None,8)))
+                levels.append(np.median(sample))
+            factors = factors*np.asarray(levels)
+        master = np.empty(shape,dtype=np.float32)
+        for start in range(0,shape[0],rowsPerBlock):
+            rows = slice(start,min(start+rowsPerBlock,shape[0]))
+            block = np.empty((len(hduls),rows.stop-rows.start,shape[1]),dtype=np.float32)
+            for f,hdul in enumerate(hduls):
+                data = np.asarray(hdul[0].section[rows],dtype=np.float32)
+                if subtract is not None: data = data - subtract(hdul[0].header,(rows,slice(None)))
+                block[f] = data/factors[f]
+            master[rows] = np.median(block,axis=0)
+        return master
+    finally:
+        for hdul in hduls: hdul.close()
+
+def cacheKey(kind,filepaths,*extra):
+    '''A key that changes if any of the input files (or the settings in extra) change, so a cached master frame can be reused until then.'''
+    digest = hashlib.sha1(kind.encode())
+    for filepath in sorted(filepaths):
+        info = os.stat(filepath)
+        digest.update('{}|{}|{}'.format(os.path.abspath(filepath),info.st_size,info.st_mtime_ns).encode())
+    for item in extra: digest.update(str(item).encode())
+    return digest.hexdigest()[:16]
+
+def cachedMaster(kind,filepaths,build,cacheDir=None,*extra):
+    '''Returns the master frame of the given kind, loading it from cacheDir if a master made from exactly the same files is there, and otherwise building it with build() and saving it there.'''
+    from astropy.io import fits
+    if cacheDir is None: return build()
+    key = cacheKey(kind,filepaths,*extra)
+    cachePath = os.path.join(cacheDir,'master_'+kind+'.fits')
+    if os.path.exists(cachePath):
+        with fits.open(cachePath) as hdul:
+            if hdul[0].header.get('QAOPKEY') == key:
+                return np.asarray(hdul[0].data,dtype=np.float32)
+    master = build()
+    os.makedirs(cacheDir,exist_ok=True)
+    header = fits.Header()
+    header['QAOPKEY'] = key
+    header['NCOMBINE'] = len(filepaths)
+    fits.PrimaryHDU(master,header).writeto(cachePath,overwrite=True)
+    return master
+
+def makeMasterBias(biasFiles,cacheDir=None,rowsPerBlock=128):
+    return cachedMaster('bias',biasFiles,lambda: medianStack(biasFiles,rowsPerBlock=rowsPerBlock),cacheDir)
+
+def makeMasterDark(darkFiles,bias=None,cacheDir=None,rowsPerBlock=128):
+    '''Makes the master dark as a dark current rate (ADU per second), so that it can be scaled to any exposure time. The bias is taken off each dark first.'''
+    from astropy.io import fits
+    times = []
+    for filepath in darkFiles:
+        times.append(exposureTime(fits.getheader(filepath),default=1.0))
+    subtract = None if bias is None else (lambda header,region: bias[region])
+    build = lambda: medianStack(darkFiles,rowsPerBlock=rowsPerBlock,subtract=subtract,scales=times)
+    return cachedMaster('dark',darkFiles,build,cacheDir,None if bias is None else hashlib.sha1(bias.tobytes()).hexdigest())
+
+def makeMasterFlat(flatFiles,bias=None,dark=None,cacheDir=None,rowsPerBlock=128):
+    '''Makes the normalised master flat (median of 1). Each flat has the bias and the dark (scaled to its exposure time) taken off, and is divided by its own median before they are combined.'''
+    def subtract(header,region):
+        level = 0.0
+        if bias is not None: level = level + bias[region]
+        if dark is not None: level = level + dark[region]*exposureTime(header)
+        return level
+    build = lambda: medianStack(flatFiles,rowsPerBlock=rowsPerBlock,subtract=subtract,normalise=True)
+    extra = [None if frame is None else hashlib.sha1(frame.tobytes()).hexdigest() for frame in (bias,dark)]
+    flat = cachedMaster('flat',flatFiles,build,cacheDir,*extra)
+    return flat/np.median(flat)
+
+
+class calibrator:
+    '''Holds the master bias, dark (per second) and flat, and applies them to frames:
+        calibrated = (raw - bias - dark*exptime)/flat
+    Any of the three can be None to skip it. If cutout is True, the photometry only has the calibration done on the boxes around the stars (see applyCutouts()), which saves doing the whole frame when there are only a few stars.'''
+
+    def __init__(self,bias=None,dark=None,flat=None,cutout=False):
+        self.bias,self.dark,self.flat = bias,dark,flat
+        self.cutout = cutout
+        self._cutoutImage,self._cutoutRegions = None,[] #the image applyCutouts() reuses, and the boxes it calibrated last time
+        if flat is not None:
+            #dead pixels in the flat would divide by zero, so they are left as nan and ignored by the photometry
+            self.flat = np.where(flat > 0,flat,np.nan).astype(np.float32)
+
+    @classmethod
+    def fromFiles(cls,biasFiles=(),darkFiles=(),flatFiles=(),cacheDir=None,cutout=False,rowsPerBlock=128):
+        '''Builds (or loads from the cacheDir) the master frames from lists of raw calibration frames. Any of the lists can be left empty.'''
+        bias = makeMasterBias(list(biasFiles),cacheDir,rowsPerBlock) if len(biasFiles) else None
+        dark = makeMasterDark(list(darkFiles),bias,cacheDir,rowsPerBlock) if len(darkFiles) else None
+        flat = makeMasterFlat(list(flatFiles),bias,dark,cacheDir,rowsPerBlock) if len(flatFiles) else None
+        return cls(bias=bias,dark=dark,flat=flat,cutout=cutout)
+
+    def checkShape(self,shape):
+        for frame in (self.bias,self.dark,self.flat):
+            if frame is not None and frame.shape != tuple(shape):
+                raise ValueError("Calibration frames are "+str(frame.shape)+" but the image is "+str(tuple(shape)))
+
+    def applyRegion(self,data,region,exptime=0.0):
+        '''Calibrates data, which is the part of an image at region (a tuple of slices, or of index arrays) of the full frame.'''
+        data = np.asarray(data,dtype=np.float32)
+        if self.bias is not None: data = data - self.bias[region]
+        if self.dark is not None and exptime: data = data - self.dark[region]*np.float32(exptime)
+        if self.flat is not None: data = data/self.flat[region]
+        return data
+
+    def apply(self,image,exptime=0.0):
+        '''Returns the calibrated copy of the whole image.'''
+        self.checkShape(image.shape)
+        return self.applyRegion(image,(slice(None),slice(None)),exptime)
+
+    def applyCutouts(self,image,centres,halfSize,exptime=0.0):
+        '''Returns an image where only the boxes of (2*halfSize+1) pixels around each (x, y) centre have been calibrated; everything else is nan, so the photometry can't use it by accident. The raw image isn't changed.
+        The same nan image is reused for every frame, and only last frame's boxes are put back to nan, so the time this takes depends on the number of boxes rather than the size of the frame. That means the image returned is only good until the next call (copy it to keep it).'''
+        self.checkShape(image.shape)
+        if self._cutoutImage is None or self._cutoutImage.shape != image.shape:
+            self._cutoutImage,self._cutoutRegions = np.full(image.shape,np.nan,dtype=np.float32),[]
+        calibrated = self._cutoutImage
+        for region in self._cutoutRegions: calibrated[region] = np.nan
+        self._cutoutRegions = []
+        ny,nx = image.shape
+        for x,y in np.asarray(centres,dtype=float).reshape(-1,2):
+            x0,x1 = max(int(np.rint(x))-halfSize,0),min(int(np.rint(x))+halfSize+1,nx)
+            y0,y1 = max(int(np.rint(y))-halfSize,0),min(int(np.rint(y))+halfSize+1,ny)
+            if x0 >= x1 or y0 >= y1: continue
+            region = (slice(y0,y1),slice(x0,x1))
+            calibrated[region] = self.applyRegion(image[region],region,exptime) #boxes that overlap just calibrate the same pixels again
+            self._cutoutRegions.append(region)
+        return calibrated
+
+    def __getstate__(self):
+        #the reused cutout image doesn't need sending to the worker processes along with the master frames
+        state = self.__dict__.copy()
+        state['_cutoutImage'],state['_cutoutRegions'] = None,[]
+        return state
+
+    def applyFor(self,image,exptime,centres,halfSize):
+        '''Calibrates an image for the photometry, either the whole thing or just the cutouts around the centres depending on "cutout".'''
+        if self.cutout: return self.applyCutouts(image,centres,halfSize,exptime)
+        return self.apply(image,exptime)
@@ -0,0 +1,227 @@
+#This module does the light curve clean up that comes after the photometry: binning in time, taking out slow trends
+# (airmass, clouds, the sky brightening near dawn...) with a rolling median, mean or polynomial, and clipping outliers.
+# Everything takes (frame, star) arrays, ie a slice of the cube from photInstance.masterAsArray(), and does every star at
+# once. The rolling means and polynomials are done with cumulative sums, so each point's window costs the same however
+# wide it is, and the rolling median uses a strided view of the windows rather than a python loop over them.
+#
+#The usual way to use it is:
+#    times, flux, err = fromPhotInstance(inst) #hours, and (frame, star) arrays
+#    flux = clipOutliers(times, flux, window=0.5) #outliers become nan
+#    flat = detrend(times, flux, window=1.0, method='poly', order=2)
+#    binnedTimes, binned, binnedErr, counts = binTimes(times, flat, binWidth=10/60)
+#Windows and bin widths are in the same units as the times; rollingMedian() counts its window in frames instead.
+
+import numpy as np
+import math
+import contextlib
+import warnings
+from numpy.lib.stride_tricks import sliding_window_view
+
+try:
+    from QAOP_utils import datesToHours, datesToJD
+except ModuleNotFoundError:
+    from QAOP.QAOP_utils import datesToHours, datesToJD
+
+
+def asColumns(values):
+    #works on (frame, star) arrays, but a single light curve can be given as a 1D array; returns the 2D version and whether to flatten it back
+    values = np.asarray(values,dtype=float)
+    return (values[:,None],True) if values.ndim == 1 else (values,False)
+
+def fromPhotInstance(inst,quantity='aperture_sum',unit='hours'):
+    '''Returns the times (hours since midnight of the first frame, or JD with unit='jd'), and the (frame, star) arrays of the quantity and its error (aperture_sum_err, or nan if the table doesn't have it) from a photInstance's master table, sorted by time.'''
+    dates,values = inst.masterAsArray([quantity,'aperture_sum_err'])
+    times = datesToJD(dates) if unit == 'jd' else datesToHours(dates)
+    order = np.argsort(times,kind='stable')
+    return times[order],values[order,:,0],values[order,:,1]
+
+#Binning section ---------
+
+def binTimes(times,values,binWidth,err=None,minCount=1):
+    '''Bins the light curves in time, into bins binWidth wide starting at the first time. times must be sorted (as they are from fromPhotInstance()).
+    Returns (bin times, binned values, binned errors, counts): the mean time of the frames in each bin, and for every star the mean (or the inverse variance weighted mean if err is given) of its finite values in the bin, the error on that, and how many values went into it. Bins with fewer than minCount values are nan.'''
+    times = np.asarray(times,dtype=float)
+    values,flatten = asColumns(values)
+    if len(times) == 0: return times,values[:0],values[:0],np.zeros(values[:0].shape,dtype=int)
+    bins = np.floor((times - times[0])/binWidth).astype(np.int64)
+    starts = np.flatnonzero(np.concatenate(([True],bins[1:] != bins[:-1])))
+    frames = np.diff(np.append(starts,len(times)))
+    binnedTimes = np.add.reduceat(times,starts)/frames
+    good = np.isfinite(values)
+    if err is not None:
+        err,_ = asColumns(err)
+        good &= np.isfinite(err) & (err > 0)
+        weights = np.where(good,1/np.where(good,err,1)**2,0.0)
+    else:
+        weights = good.astype(float)
+    counts = np.add.reduceat(good.astype(np.int64),starts,axis=0)
+    weightSum = np.add.reduceat(weights,starts,axis=0)
+    with np.errstate(divide='ignore',invalid='ignore'):
+        binned = np.add.reduceat(np.where(good,values,0.0)*weights,starts,axis=0)/weightSum
+        if err is not None:
+            binnedErr = 1/np.sqrt(weightSum)
+        else:
+            #the standard error of the mean, from the scatter inside each bin
+            squares = np.add.reduceat(np.where(good,values,0.0)**2,starts,axis=0)
+            variance = np.clip(squares/counts - binned**2,0,None)*counts/(counts - 1)
+            binnedErr = np.sqrt(variance/counts)
+    empty = counts < max(minCount,1)
+    binned[empty] = np.nan
+    binnedErr[empty] = np.nan
+    if flatten: return binnedTimes,binned[:,0],binnedErr[:,0],counts[:,0]
+    return binnedTimes,binned,binnedErr,counts
+
+def binFrames(values,count):
+    '''Averages every "count" frames together (the last bin gets whatever is left over), ignoring nan values. Works for the times too.'''
+    values,flatten = asColumns(values)
+    starts = np.arange(0,len(values),count)
+    good = np.isfinite(values)
+    with np.errstate(divide='ignore',invalid='ignore'):
+        binned = np.add.reduceat(np.where(good,values,0.0),starts,axis=0)/np.add.reduceat(good.astype(float),starts,axis=0)
+    return binned[:,0] if flatten else binned
+
+#Rolling section ---------
+#Each point's window is the points within window/2 of it in time, found for every point at once with searchsorted. The
+# sums over a window are then the difference of two cumulative sums, so they cost the same however long the window is.
+
+def windowBounds(times,window):
+    #the index of the first point in each point's window, and one past the last
+    times = np.asarray(times,dtype=float)
+    return np.searchsorted(times,times - window/2,side='left'),np.searchsorted(times,times + window/2,side='right')
+
+def windowSums(columns,first,last):
+    #the sum of each column over every window, for an (N, ...) array of columns
+    cumulative = np.concatenate((np.zeros((1,)+columns.shape[1:]),np.cumsum(columns,axis=0)))
+    return cumulative[last] - cumulative[first]
+
+def rollingMean(times,values,window):
+    '''The mean of each star's finite values within window/2 (in time) of each frame.'''
+    values,flatten = asColumns(values)
+    first,last = windowBounds(times,window)
+    good = np.isfinite(values)
+    with np.errstate(divide='ignore',invalid='ignore'):
+        mean = windowSums(np.where(good,values,0.0),first,last)/windowSums(good.astype(float),first,last)
+    return mean[:,0] if flatten else mean
+
+def localWindowSums(times,columns,window,first,last,powers):
+    #the sum over each frame's window of columns*((t - t_frame)/window)^p, for p up to powers-1, for an (N, star) array of columns.
+    # Summing powers of the times themselves loses the precision of narrow windows far from the start of the night, so the
+    # powers are taken from the start of each window long block of time instead (which keeps them small), and then moved
+    # onto each frame with the binomial expansion. A window can't cover more than two blocks, so that is two cumsum differences.
+    tau = (times - times[0])/window
+    block = np.floor(tau)
+    p = np.arange(powers)
+    local = columns[:,:,None]*((tau - block)[:,None]**p[None,:])[:,None,:] #(frame, star, power)
+    cumulative = np.concatenate((np.zeros((1,)+local.shape[1:]),np.cumsum(local,axis=0)))
+    blockStart = np.searchsorted(block,block,side='left') #the first frame of each frame's block
+    split = np.maximum(blockStart[last - 1],first) #where the window crosses into the next block (or its first frame)
+    binomial = np.array([[math.comb(i,j) for j in p] for i in p],dtype=float)
+    exponents = np.clip(p[:,None] - p[None,:],0,None)
+    sums = 0
+    for ref,start,end in [(block[first],first,split),(block[last - 1],split,last)]:
+        shift = binomial[None,:,:]*(ref - tau)[:,None,None]**exponents[None,:,:] #(frame, power, power)
+        sums = sums + np.einsum('fpq,fsq->fsp',shift,cumulative[end] - cumulative[start])
+    return sums
+
+def rollingPolynomial(times,values,window,order=2):
+    '''Fits a polynomial of the given order to each star's finite values within window/2 (in time) of each frame, and returns the fit's value at that frame. This follows a curving trend better than the rolling mean does, and the windows at the start and end of the night aren't pulled towards the middle.
+    The least squares sums for every window come from cumulative sums (see localWindowSums()), so it is O(frames*stars) for any window.'''
+    values,flatten = asColumns(values)
+    times = np.asarray(times,dtype=float)
+    if len(times) == 0: return values[:,0] if flatten else values.copy()
+    first,last = windowBounds(times,window)
+    good = np.isfinite(values)
+    #the normal equations for each frame and star, with the polynomial centred on the frame: A[k,j] = sum of x^(k+j), b[k] = sum of y*x^k
+    xSums = localWindowSums(times,good.astype(float),window,first,last,2*order + 1) #(frame, star, power)
+    ySums = localWindowSums(times,np.where(good,values,0.0),window,first,last,order + 1)
+    k = np.arange(order+1)
+    A = xSums[:,:,k[:,None]+k[None,:]]
+    enough = xSums[:,:,0] > order
+    A = np.where(enough[:,:,None,None],A,np.eye(order+1))
+    with quietNan():
+        #centred on the frame, the fit's value there is just the constant term
+        fit = np.linalg.solve(A,ySums[:,:,:,None])[:,:,0,0]
+    fit[~enough] = np.nan
+    return fit[:,0] if flatten else fit
+
+def windowMedian(windows):
+    #the median of the non-nan values along the last axis, for an array of windows (nan if there aren't any). nan sorts to the
+    # end, so once each window is partitioned around the middle of its real values the median can be picked straight out;
+    # windows with different numbers of nans have different middles, so it partitions around each of them.
+    real = windows.shape[-1] - np.isnan(windows).sum(axis=-1)
+    if real.size == 0 or real.min() == windows.shape[-1]: return np.median(windows,axis=-1)
+    counts = np.unique(real[real > 0])
+    middles = np.unique(np.concatenate(((counts - 1)//2,counts//2)))
+    ordered = np.sort(windows,axis=-1) if len(middles) > 32 else np.partition(windows,middles,axis=-1)
+    lower = np.take_along_axis(ordered,np.maximum(real - 1,0)[...,None]//2,axis=-1)[...,0]
+    upper = np.take_along_axis(ordered,real[...,None]//2,axis=-1)[...,0]
+    return np.where(real > 0,(lower + upper)/2,np.nan)
+
+def rollingMedian(values,window,step=1,chunk=None):
+    '''The median of each star's values over a window of "window" frames centred on each frame (it is made odd if it isn't), ignoring nan values. The windows come from a strided view of the array, so none are copied out one at a time; near the ends of the night the windows just get shorter.
+    With step > 1 the median is only worked out every "step" frames (and at the last full window) and linearly interpolated in between, which is much quicker for wide windows and makes little difference to a slow trend. To keep the memory down, the windows are done "chunk" at a time (by default, enough to keep each chunk to a few million values).'''
+    values,flatten = asColumns(values)
+    half = int(window)//2
+    n = len(values)
+    median = np.full(values.shape,np.nan)
+    if 2*half+1 <= n:
+        windows = sliding_window_view(values,2*half+1,axis=0) #(frame - 2*half, star, window), a view of values
+        starts = np.unique(np.append(np.arange(0,len(windows),max(int(step),1)),len(windows) - 1))
+        if chunk is None: chunk = max(1,4000000//max(windows.shape[1]*windows.shape[2],1))
+        medians = np.empty((len(starts),values.shape[1]))
+        for first in range(0,len(starts),chunk):
+            medians[first:first+chunk] = windowMedian(windows[starts[first:first+chunk]])
+        if len(starts) == len(windows):
+            median[half:n-half] = medians
+        else:
+            for star in range(values.shape[1]):
+                median[half:n-half,star] = np.interp(np.arange(len(windows)),starts,medians[:,star])
+        edges = list(range(half)) + list(range(n-half,n))
+    else:
+        edges = range(n)
+    for f in edges:
+        median[f] = windowMedian(values[max(f-half,0):f+half+1].T)
+    return median[:,0] if flatten else median
+
+@contextlib.contextmanager
+def quietNan():
+    #all-nan windows and empty bins give nan, which is what we want, so the warnings about them aren't needed
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore',RuntimeWarning)
+        with np.errstate(invalid='ignore',divide='ignore'):
+            yield
+
+#Detrending section ---------
+
+def trend(times,values,window,method='median',order=2,step=None):
+    '''Works out the slow trend of each light curve with one of the rolling functions: method can be 'median' (window in time, converted to frames with the median cadence), 'mean' or 'poly' (a rolling polynomial of the given order).
+    The median is worked out every "step" frames and interpolated in between (see rollingMedian()); by default that is every twentieth of a window.'''
+    if method == 'mean': return rollingMean(times,values,window)
+    if method == 'poly': return rollingPolynomial(times,values,window,order=order)
+    if method == 'median':
+        cadence = np.median(np.diff(times)) if len(times) > 1 else window
+        frames = max(int(round(window/cadence)),1) if cadence > 0 else 1
+        return rollingMedian(values,frames,step=max(frames//20,1) if step is None else step)
+    raise ValueError("Unknown detrending method "+repr(method)+", it should be 'median', 'mean' or 'poly'")
+
+def detrend(times,values,window,method='median',order=2,step=None,divide=True):
+    '''Takes the trend() out of each light curve: dividing by it (for fluxes, so the result is relative flux around 1) or, with divide=False, subtracting it (for magnitudes).'''
+    values = np.asarray(values,dtype=float)
+    slow = trend(times,values,window,method=method,order=order,step=step)
+    with np.errstate(divide='ignore',invalid='ignore'):
+        return values/slow if divide else values - slow
+
+def clipOutliers(times,values,window,sigma=4.0,iterations=3,method='median',step=None):
+    '''Sets the points that are more than sigma (robust) standard deviations from the rolling trend to nan, repeating until nothing more is clipped or "iterations" runs out. The standard deviation of each star comes from the median absolute deviation of its residuals, so the outliers themselves don't inflate it.
+    Returns a copy of the values with the outliers as nan.'''
+    values = np.array(values,dtype=float)
+    clipped,flatten = asColumns(values)
+    for iteration in range(iterations):
+        residuals = clipped - asColumns(trend(times,clipped,window,method=method,step=step))[0]
+        with quietNan():
+            mad = np.nanmedian(np.abs(residuals - np.nanmedian(residuals,axis=0)),axis=0)
+        with np.errstate(invalid='ignore'):
+            outliers = np.abs(residuals) > sigma*1.4826*mad
+        if not outliers.any(): break
+        clipped[outliers] = np.nan
+    return clipped[:,0] if flatten else clipped
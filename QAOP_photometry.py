@@ -1,14 +1,12 @@
 import numpy as np
-from photutils.aperture import aperture_photometry #main photometry package/method - inherently linked to the apertures we import later
-from photutils.aperture import ApertureStats #For getting the median and area that we use to calculate the background
-from astropy.table import Table #For handling tables
-from photutils.aperture import SkyCircularAperture, SkyCircularAnnulus
-from astropy.coordinates import SkyCoord #for defining aperture positions
-import astropy.units as u #Need 'deg' and 'arcsec' for skycoord and aperture
-from astropy.io import fits #for loading fits files
-from astropy.wcs import WCS #for getting WCS data from header
 import os #for file handling and saving!
 import io #for writing simple log files!
+import time #for timing the stages when stats are turned on
+import json #for the structured stats log
+import contextlib
+#photutils and astropy take most of a second to import, so they are imported inside the functions that use them
+# (photutils.aperture for the photometry, astropy.table for the master table, astropy.io.fits and astropy.wcs for
+# loading frames) rather than up here. That way scripts that only need part of the module start straight away.
 
 
 #load config file data
@@ -16,22 +14,46 @@ try:
     from QAOP_utils import readConfigFile
 except ModuleNotFoundError:
     from QAOP.QAOP_utils import readConfigFile
-codeFilePath,dataFilePath,errormsg = readConfigFile()
-#print(codeFilePath,dataFilePath,errormsg)
+
+#The config file is read the first time one of its paths is needed rather than when the module is imported, so
+# QAOP_photometry.dataFilePath (etc) still work but importing the module doesn't touch the disk.
+configPaths = None
+
+def getConfigPaths():
+    '''Returns (codeFilePath, dataFilePath, errormsg) from the config file, reading it the first time only.'''
+    global configPaths
+    if configPaths is None: configPaths = readConfigFile()
+    return configPaths
 
 #------------------
 #These paths should be changed if needed
-ApertureFilePath = dataFilePath + "apertures.csv"
-PhotometryFilePath = dataFilePath + "photometry_master.ecsv"
+defaultPaths = {'ApertureFilePath':"apertures.csv",'PhotometryFilePath':"photometry_master.ecsv"}
 #------------------
 
+def __getattr__(name):
+    #only called for names that aren't already in the module, ie the config paths above
+    if name in ('codeFilePath','dataFilePath','errormsg'):
+        return getConfigPaths()[('codeFilePath','dataFilePath','errormsg').index(name)]
+    if name in defaultPaths:
+        return getConfigPaths()[1] + defaultPaths[name]
+    raise AttributeError("module "+repr(__name__)+" has no attribute "+repr(name))
+
+#The values that photValWrapper() stores for each aperture, in the order the export methods use by default
+resultValueNames = ["aperture_raw_sum","aperture_area","annulus_median","background_to_subtract","aperture_sum","aperture_sum_err"]
 
 
-def loadAperturesFromFile(ApertureFilePath=ApertureFilePath):
+
+def loadAperturesFromFile(ApertureFilePath=None):
     '''Creates a list of both apertures and annuli, as well as a list of names that they were assigned. It reads in from a file, which should be a table written by the STARID & RADIALPROF scripts in the QAOP package. Namely, this should be a table with the columns 
     Name | RA | DEC | r | r_in | r_out
     Where each line is a star location, with the name it was assigned, it's location in RA and DEC (ICRS), and as well, the radius of the stars aperture itself, as well as the inner and outer radius for the annulus that is used to determine the local background for that star.
+    If no ApertureFilePath is given, the apertures.csv in the config file's data directory is used.
     '''
+    from astropy.table import Table
+    from astropy.coordinates import SkyCoord #for defining aperture positions
+    import astropy.units as u #Need 'deg' and 'arcsec' for skycoord and aperture
+    from photutils.aperture import SkyCircularAperture, SkyCircularAnnulus
+    if ApertureFilePath is None: ApertureFilePath = getConfigPaths()[1] + defaultPaths['ApertureFilePath']
     apertureTab = Table.read(ApertureFilePath)
 
     names,apertures,annuli = [],[],[]
@@ -52,6 +74,7 @@ def loadAperturesFromFile(ApertureFilePath=ApertureFilePath):
 #The following 5 functions each perform a base component of the total photometry process, and are then wrapped into a single callable function in the 6th function.
 
 def getRawSum(image,aperture,wcs):
+    from photutils.aperture import aperture_photometry #main photometry package/method - inherently linked to the apertures
     photResults = aperture_photometry(image,aperture,wcs=wcs)
     aperture_raw_sum = photResults["aperture_sum"].data[0] 
     #its ready for multiple apertures, so they're returned in an array
@@ -59,6 +82,7 @@ def getRawSum(image,aperture,wcs):
     return aperture_raw_sum
 
 def getArea(image,aperture,wcs):
+    from photutils.aperture import ApertureStats #For getting the median and area that we use to calculate the background
     #aperture_area = ApertureStats(image,aperture,wcs=wcs)["area"].data
     aperture_area = ApertureStats(image,aperture,wcs=wcs).sum_aper_area.value 
     #    we don't care that it's pix^2
@@ -66,7 +90,15 @@ def getArea(image,aperture,wcs):
     #print(aperture_area.value)
     return aperture_area
 
+def getPixelArea(image,pixel_aperture):
+    #the same area as getArea() (the part of the aperture that is on the image, leaving out nan pixels), but from the pixel aperture's own mask rather than a whole ApertureStats
+    mask = pixel_aperture.to_mask(method='exact')
+    large,small = mask.get_overlap_slices(image.shape)
+    if large is None: return np.nan
+    return float(np.sum(mask.data[small][np.isfinite(image[large])]))
+
 def getMedian(image,annulus,wcs):
+    from photutils.aperture import ApertureStats
     annulus_stats = ApertureStats(image,annulus,wcs=wcs)
     #aperture_median_background = annulus_stats["median"].data
     aperture_median_background = annulus_stats.median
@@ -80,11 +112,96 @@ def subBackground(raw_sum, back_to_sub):
     adjusted_sum = raw_sum - back_to_sub
     return adjusted_sum
 
-def photValWrapper(image,aperture,annulus,wcs):
-    '''This function packages together all the base component info gathering into a single function, and will return a dictionary with the values for that aperture. This result is then added to a new dictionary, which maps the aperture names to the result dictionaries for each of the apertures. This is then saved to a master 3D table as a single row for the timestamp of the image.'''
-    aperture_raw_sum = getRawSum(image,aperture,wcs)
-    aperture_area = getArea(image,aperture,wcs)
-    annulus_median = getMedian(image,annulus,wcs)
+#Background section ---------
+#getMedian() builds a whole ApertureStats for every star just to take one median, and a neighbouring star that falls in
+# the annulus pulls that median up. These instead gather the annulus pixels of every star into one (star, pixel) buffer,
+# using index arrays worked out for all of the stars at once, and then sigma clip and take the median of every row together.
+
+def annulusIndices(shape,pixel_annuli):
+    '''Works out which image pixels are in each of the (pixel) annuli. Every star gets the same square grid of candidate pixels around it, so the result is a pair of (star, pixel) row and column index arrays, along with a mask of which of those pixels are really in the annulus (and in the image).
+    A pixel is counted if its centre is in the annulus, which is the same rule ApertureStats uses.'''
+    centres = np.array([annulus.positions for annulus in pixel_annuli],dtype=float).reshape(-1,2)
+    r_in = np.array([annulus.r_in for annulus in pixel_annuli],dtype=float)
+    r_out = np.array([annulus.r_out for annulus in pixel_annuli],dtype=float)
+    reach = int(np.ceil(r_out.max())) + 1 if len(r_out) else 1
+    oy,ox = np.mgrid[-reach:reach+1,-reach:reach+1]
+    cols = np.rint(centres[:,0])[:,None].astype(int) + ox.ravel()[None,:]
+    rows = np.rint(centres[:,1])[:,None].astype(int) + oy.ravel()[None,:]
+    dist2 = (cols - centres[:,0,None])**2 + (rows - centres[:,1,None])**2
+    members = (dist2 >= r_in[:,None]**2) & (dist2 < r_out[:,None]**2)
+    members &= (rows >= 0) & (rows < shape[0]) & (cols >= 0) & (cols < shape[1])
+    return np.clip(rows,0,shape[0]-1),np.clip(cols,0,shape[1]-1),members
+
+def clippedRowStats(values,sigma=3.0,maxiters=5):
+    '''Sigma clips each row of a (star, pixel) array (with nan for pixels that don't count) about its median, all rows at once, and returns the median, mean, standard deviation and number of the pixels left in each row.
+    Each row is sorted once (the nans go to the end). Clipping can then only take values off either end of a row, so each pass just moves the two ends of the kept range in, and the sums for the mean and standard deviation come from cumulative sums along the sorted rows.'''
+    ordered = np.sort(values,axis=1)
+    rowIndex = np.arange(len(ordered))
+    lo = np.zeros(len(ordered),dtype=np.int64)
+    hi = np.sum(~np.isnan(ordered),axis=1)
+    ordered = ordered[:,:max(hi.max(initial=0),1)] #past the longest row it is all nan
+    last = ordered.shape[1] - 1
+    def middle(lo,hi):
+        n = hi - lo
+        lower = ordered[rowIndex,np.clip(lo + (n - 1)//2,0,last)]
+        upper = ordered[rowIndex,np.clip(lo + n//2,0,last)]
+        return np.where(n > 0,(lower + upper)/2,np.nan)
+    #the sums are taken about each row's starting median, so the sum of squares doesn't lose the precision of a small scatter on a bright sky
+    offset = np.nan_to_num(middle(lo,hi))
+    shifted = np.where(np.isnan(ordered),0.0,ordered - offset[:,None])
+    zeros = np.zeros((len(ordered),1))
+    sums = np.concatenate((zeros,np.cumsum(shifted,axis=1)),axis=1)
+    squares = np.concatenate((zeros,np.cumsum(shifted**2,axis=1)),axis=1)
+    def moments(lo,hi):
+        n = hi - lo
+        with np.errstate(invalid='ignore',divide='ignore'):
+            mean = (sums[rowIndex,hi] - sums[rowIndex,lo])/n
+            variance = np.clip((squares[rowIndex,hi] - squares[rowIndex,lo])/n - mean**2,0,None)
+        return mean + offset,np.sqrt(variance)
+    for iteration in range(maxiters if sigma is not None else 0):
+        median = middle(lo,hi)
+        mean,std = moments(lo,hi)
+        with np.errstate(invalid='ignore'):
+            newLo = np.maximum(lo,np.sum(ordered < (median - sigma*std)[:,None],axis=1))
+            newHi = np.minimum(hi,np.sum(ordered <= (median + sigma*std)[:,None],axis=1))
+        newHi = np.where(hi > lo,newHi,hi) #an empty row stays as it is
+        if np.array_equal(newLo,lo) and np.array_equal(newHi,hi): break
+        lo,hi = newLo,newHi
+    mean,std = moments(lo,hi)
+    return middle(lo,hi),mean,std,hi - lo
+
+def annulusBackgrounds(image,pixel_annuli,sigma=3.0,maxiters=5,statistic='median'):
+    '''Estimates the background level in every annulus with one set of array operations. The annulus pixels are sigma clipped (sigma=None turns this off, which gives the same medians as getMedian()), and then either their 'median' or 'mode' (2.5*median - 1.5*mean, as SExtractor uses) is taken.
+    Only the annulus pixels are gathered out of the image (and then turned into floats), so the frame itself is never copied.
+    Returns a dictionary of arrays (one value per star) with the "background", the clipped standard deviation "std", and "npix", the number of pixels left after clipping.'''
+    rows,cols,members = annulusIndices(image.shape,pixel_annuli)
+    values = np.asarray(image)[rows,cols].astype(float)
+    values[~members | ~np.isfinite(values)] = np.nan
+    median,mean,std,npix = clippedRowStats(values,sigma=sigma,maxiters=maxiters)
+    background = median if statistic == 'median' else 2.5*median - 1.5*mean
+    return {'background':background,'std':std,'npix':npix}
+
+def fluxUncertainties(aperture_sum,area,sky_std,sky_npix,gain=1.0,readNoise=0.0):
+    '''Works out the uncertainty (in ADU) on the background subtracted sum of every star at once, with the CCD equation:
+        error^2 = (poisson noise on the star) + area*(1 + area/sky_npix)*(sky noise per pixel)^2
+    where the area/sky_npix part is the error from only knowing the background level from sky_npix annulus pixels. The sky noise per pixel is the scatter of the annulus pixels, which already includes the read noise; the read noise is only used as a floor for it.
+    gain is in e-/ADU and readNoise in e-, as in the FITS header.'''
+    aperture_sum,area = np.asarray(aperture_sum,dtype=float),np.asarray(area,dtype=float)
+    sky_var = np.maximum(np.asarray(sky_std,dtype=float)**2,(readNoise/gain)**2)
+    with np.errstate(invalid='ignore',divide='ignore'):
+        variance = np.clip(aperture_sum,0,None)/gain + area*(1 + area/np.asarray(sky_npix,dtype=float))*sky_var
+    return np.sqrt(variance)
+
+#end background section -------
+
+def photValWrapper(image,aperture,annulus,wcs,stats=None,annulus_median=None):
+    '''This function packages together all the base component info gathering into a single function, and will return a dictionary with the values for that aperture. This result is then added to a new dictionary, which maps the aperture names to the result dictionaries for each of the apertures. This is then saved to a master 3D table as a single row for the timestamp of the image.
+    The apertures can either be sky apertures along with the wcs, or apertures that have already been converted to pixels (in which case wcs should be None, and the area comes from getPixelArea()). If the background level has already been worked out (ie, by annulusBackgrounds()) it can be passed in as annulus_median, otherwise getMedian() is used.'''
+    with timedStage(stats,'aperture_sum'):
+        aperture_raw_sum = getRawSum(image,aperture,wcs)
+    with timedStage(stats,'aperture_stats'):
+        aperture_area = getArea(image,aperture,wcs) if wcs is not None else getPixelArea(image,aperture)
+        if annulus_median is None: annulus_median = getMedian(image,annulus,wcs)
     aperture_background = calcBackground(aperture_area,annulus_median)
     aperture_sum = subBackground(aperture_raw_sum,aperture_background)
     resultDict = {}
@@ -97,25 +214,150 @@ def photValWrapper(image,aperture,annulus,wcs):
 
 def photometryValueWrapper(image,aperture,annulus,wcs): return photValWrapper(image,aperture,annulus,wcs)
 
-def doForApertures(image,names,apertures,annuli,wcs):
+#Recentering section ---------
+#The apertures are placed exactly where the catalog says, so if the WCS is a little off or the pointing drifts, the stars
+# aren't quite in the middle of them. These refine every star's pixel position with one set of array operations per frame:
+# a box (stamp) around each star is cut out of the image all at once, and the centroids of all the stamps are found together.
+
+def cutStamps(image,x,y,box):
+    '''Cuts a box x box stamp around each (rounded) position out of the image in one go, returning the (star, box, box) array of stamps, the integer centres, and a mask of which stamps were fully inside the image (the others are filled with nan).'''
+    half = box//2
+    ix,iy = np.rint(x).astype(int),np.rint(y).astype(int)
+    inside = (ix-half >= 0) & (iy-half >= 0) & (ix+half < image.shape[1]) & (iy+half < image.shape[0])
+    offsets = np.arange(-half,half+1)
+    rows = np.clip(iy[:,None,None] + offsets[None,:,None],0,image.shape[0]-1)
+    cols = np.clip(ix[:,None,None] + offsets[None,None,:],0,image.shape[1]-1)
+    stamps = np.asarray(image)[rows,cols].astype(float) #only the stamps are turned into floats, not the whole frame
+    stamps[~inside] = np.nan
+    return stamps,ix,iy,inside
+
+def batchCentroids(image,x,y,box=11,iterations=2):
+    '''Finds the centroid of each star near the pixel positions x,y, for all of the stars at once. Each stamp has its background (the median of its edge pixels) taken off, and then the intensity weighted centre is found; this is repeated "iterations" times, re-cutting the stamps around the new centres.
+    Returns the new x and y positions, and a mask of the stars that could be centroided (stars too close to the edge, or with no flux above the background, keep the position they were given).'''
+    x,y = np.array(x,dtype=float),np.array(y,dtype=float)
+    ok = np.ones(len(x),dtype=bool)
+    half = box//2
+    offsets = np.arange(-half,half+1)
+    for iteration in range(iterations):
+        stamps,ix,iy,inside = cutStamps(image,x,y,box)
+        edges = np.concatenate((stamps[:,0,:],stamps[:,-1,:],stamps[:,1:-1,0],stamps[:,1:-1,-1]),axis=1)
+        background = np.median(edges,axis=1)
+        weights = np.clip(stamps - background[:,None,None],0,None)
+        total = weights.sum(axis=(1,2))
+        good = inside & (total > 0)
+        with np.errstate(invalid='ignore',divide='ignore'):
+            dx = (weights.sum(axis=1)*offsets[None,:]).sum(axis=1)/total
+            dy = (weights.sum(axis=2)*offsets[None,:]).sum(axis=1)/total
+        x = np.where(good,ix + dx,x)
+        y = np.where(good,iy + dy,y)
+        ok &= good
+    return x,y,ok
+
+def movedAperture(aperture,position):
+    #a new aperture of the same shape at the new position; this is much quicker than copying it and setting .positions, which makes photutils reset all of its cached properties
+    return type(aperture)(position,**{param:getattr(aperture,param) for param in aperture._params if param != 'positions'})
+
+def recenterApertures(image,pixel_apertures,pixel_annuli,box=11,maxShift=3.0,iterations=2):
+    '''Moves each of the pixel apertures (and their annuli) onto the centroid of their star, as found by batchCentroids(). Stars that can't be centroided, or whose centroid is more than maxShift pixels away (probably a neighbour or a cosmic ray), are left where they were.
+    Returns the new aperture and annulus lists, and the (dx, dy) shift of each star.'''
+    positions = np.array([aperture.positions for aperture in pixel_apertures],dtype=float).reshape(-1,2)
+    new_x,new_y,ok = batchCentroids(image,positions[:,0],positions[:,1],box=box,iterations=iterations)
+    shift = np.column_stack((new_x - positions[:,0],new_y - positions[:,1]))
+    ok &= np.hypot(shift[:,0],shift[:,1]) <= maxShift
+    shift[~ok] = 0.0
+    moved_apertures,moved_annuli = [],[]
+    for i in range(len(pixel_apertures)):
+        aperture,annulus = pixel_apertures[i],pixel_annuli[i]
+        if ok[i]:
+            aperture = movedAperture(aperture,positions[i] + shift[i])
+            annulus = movedAperture(annulus,positions[i] + shift[i])
+        moved_apertures.append(aperture)
+        moved_annuli.append(annulus)
+    return moved_apertures,moved_annuli,shift
+
+#end recentering section -------
+
+def doForApertures(image,names,apertures,annuli,wcs,stats=None,recenterBox=None,maxShift=3.0,backgroundSigma=3.0,backgroundStatistic='median',gain=1.0,readNoise=0.0,calibration=None,exptime=0.0):
     '''A function that calls photValWrapper() for each of the apertures it is given, and saves the result dictionary returned from that call to a new dictionary where the key is the name assigned to the aperture it passed.
     
-    The parameter "apertures" should be the result of the aperture preparation, namely, it should be a list of SkyCircularAperture in the same order as names and annuli, such as that returned by loadAperturesFromFile().'''
+    The parameter "apertures" should be the result of the aperture preparation, namely, it should be a list of SkyCircularAperture in the same order as names and annuli, such as that returned by loadAperturesFromFile().
+    Each aperture and annulus is converted to pixels once here, rather than separately by each of the photometry functions.
+    If recenterBox is given (a stamp size in pixels, ie 11), each aperture is moved onto its star's centroid first (see recenterApertures()), and the shift is added to the results as "centroid_dx" and "centroid_dy".
+    The backgrounds of all of the annuli are found together by annulusBackgrounds(), sigma clipped at backgroundSigma (None for no clipping). The uncertainty on each aperture_sum is then added as "aperture_sum_err" (see fluxUncertainties(); gain and readNoise should come from the header).
+    If a calibration (a QAOP_calibration.calibrator) is given, the raw image is calibrated first, using the exposure time for the dark. In cutout mode only the boxes around the stars are done, which is why it happens after the apertures are converted to pixels.'''
     image_results = {}
+    with timedStage(stats,'projection'):
+        pixel_apertures = [aperture.to_pixel(wcs) for aperture in apertures]
+        pixel_annuli = [annulus.to_pixel(wcs) for annulus in annuli]
+    if calibration is not None:
+        with timedStage(stats,'calibrate'):
+            centres = np.array([annulus.positions for annulus in pixel_annuli],dtype=float).reshape(-1,2)
+            halfSize = int(np.ceil(max([annulus.r_out for annulus in pixel_annuli],default=0))) + 2
+            if recenterBox: halfSize += recenterBox//2 + int(np.ceil(maxShift))
+            image = calibration.applyFor(image,exptime,centres,halfSize)
+    shift = None
+    if recenterBox:
+        with timedStage(stats,'recenter'):
+            pixel_apertures,pixel_annuli,shift = recenterApertures(image,pixel_apertures,pixel_annuli,box=recenterBox,maxShift=maxShift)
+    with timedStage(stats,'background'):
+        backgrounds = annulusBackgrounds(image,pixel_annuli,sigma=backgroundSigma,statistic=backgroundStatistic)
     for i,name in enumerate(names): #I figure I'll need the i to acces the things about the aperture I've currently got referenced by name
         aperture_name = name
-        aperture_results = photValWrapper(image,apertures[i],annuli[i],wcs=wcs)
+        aperture_results = photValWrapper(image,pixel_apertures[i],pixel_annuli[i],wcs=None,stats=stats,annulus_median=backgrounds['background'][i])
+        if shift is not None:
+            aperture_results["centroid_dx"],aperture_results["centroid_dy"] = shift[i]
         image_results[aperture_name] = aperture_results #save the result dict to a dict with what it was the result for
+    #the errors for all of the stars are done together, now that the sums are known
+    errors = fluxUncertainties([image_results[name]["aperture_sum"] for name in names],[image_results[name]["aperture_area"] for name in names],
+                               backgrounds['std'],backgrounds['npix'],gain=gain,readNoise=readNoise)
+    for i,name in enumerate(names):
+        image_results[name]["aperture_sum_err"] = errors[i]
     return image_results
 
 #The next section of the program deals with File IO and thusly iterating through a selection of images and doing the photometry on each of them.
 
-def loadImageAndWCS(filepath):
-    with fits.open(filepath) as hdul:
-        image = hdul[0].data
-        wcs = WCS(hdul[0].header)
+def loadImageAndWCS(filepath,stats=None):
+    image,wcs,img_time,detector = loadFrame(filepath,stats=stats)
+    return image,wcs,img_time
+
+#The header keywords that different camera software uses for the gain (e-/ADU) and read noise (e-)
+GAIN_KEYS = ['GAIN','EGAIN','CCDGAIN']
+READNOISE_KEYS = ['RDNOISE','READNOIS','RDNOIS','READNOISE']
+
+def getDetectorParams(header,gain=1.0,readNoise=0.0):
+    '''Reads the gain and read noise (and the exposure time, for scaling the dark) out of a FITS header, using the defaults given if they aren't there. Returns them as a dictionary with "gain", "readNoise" and "exptime".'''
+    exptime = 0.0
+    for key in ['EXPTIME','EXPOSURE']:
+        if key in header:
+            exptime = float(header[key])
+            break
+    for key in GAIN_KEYS:
+        if key in header:
+            gain = float(header[key])
+            break
+    for key in READNOISE_KEYS:
+        if key in header:
+            readNoise = float(header[key])
+            break
+    return {'gain':gain,'readNoise':readNoise,'exptime':exptime}
+
+def loadFrame(filepath,stats=None):
+    '''The same as loadImageAndWCS(), but it also returns the detector parameters (see getDetectorParams()) from the header, which are needed for the uncertainties.
+    Normally the file is opened with astropy's defaults, so an unscaled frame is memory mapped and only really read (and byte swapped) by whatever first uses it. When stats are on it is read into memory and put into this machine's byte order straight away instead, so that the cost shows up in the fits_decode stage rather than in the photometry stages.'''
+    from astropy.io import fits #for loading fits files
+    from astropy.wcs import WCS #for getting WCS data from header
+    #memmap=True can't be asked for outright: astropy refuses it for scaled frames (BZERO/BSCALE, ie every unsigned 16 bit CCD frame)
+    with (fits.open(filepath) if stats is None else fits.open(filepath,memmap=False)) as hdul:
+        with timedStage(stats,'fits_decode'):
+            image = hdul[0].data
+            if stats is not None and image is not None and not image.dtype.isnative:
+                image = image.astype(image.dtype.newbyteorder('='))
+        with timedStage(stats,'wcs'):
+            wcs = WCS(hdul[0].header)
         img_time = hdul[0].header['date-obs']
-        return image,wcs,img_time
+        detector = getDetectorParams(hdul[0].header)
+        if stats is not None: stats.addBytes(os.path.getsize(filepath))
+        return image,wcs,img_time,detector
     
 def doForFile(filepath,names,apertures,annuli):
     '''This function is designed to be used and called by a wrapper iterating though a subset of files. '''
@@ -123,6 +365,126 @@ def doForFile(filepath,names,apertures,annuli):
     #I need to do something better with the output from this; like saving it to a table
     return img_time, doForApertures(image,names,apertures,annuli,wcs)
 
+#Stats section ---------
+#When a reduction is slow, these let you see where the time is going. Every function above takes an optional "stats"
+# and wraps each of its stages in timedStage(); when stats is None that is just a shared do-nothing context, so it
+# doesn't cost anything unless it's turned on.
+
+nullStage = contextlib.nullcontext()
+
+def timedStage(stats,stage_name):
+    if stats is None: return nullStage
+    return stats.stage(stage_name)
+
+class photStats:
+    '''Records the wall time spent in each stage of the photometry (fits_decode, wcs, projection, aperture_sum, aperture_stats, save_table, log), the bytes read, and the memory, for every frame.
+    Each frame is stored as a dictionary in "frames", and summary() adds them all up. If logPath is given, each frame's dictionary is also written as a line of JSON to that file as soon as the frame is done.
+    profiler can be 'cprofile' or 'pyinstrument' to also profile each frame, saving the result for each frame into profileDir.'''
+
+    def __init__(self,logPath=None,profiler=None,profileDir='.'):
+        self.frames = []
+        self.current = None
+        self.logPath = logPath
+        self.profiler,self.profileDir = profiler,profileDir
+        self._profile = None
+        self.pending = {} #frames whose loading was timed ahead of time, by frame name (see preloaded())
+
+    def startFrame(self,frame_name):
+        self.current = {'frame':frame_name,'stages':{},'bytes_read':0}
+        self._frame_start = time.perf_counter()
+        self._preloaded_s = 0.0
+        early = self.pending.pop(frame_name,None)
+        if early is not None:
+            self.current['stages'].update(early['stages'])
+            self.current['bytes_read'] += early['bytes_read']
+            self._preloaded_s = sum(early['stages'].values())
+        if self.profiler == 'cprofile':
+            import cProfile
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        elif self.profiler == 'pyinstrument':
+            from pyinstrument import Profiler
+            self._profile = Profiler()
+            self._profile.start()
+
+    def endFrame(self,image=None):
+        frame = self.current
+        if frame is None: return None
+        frame['total_s'] = time.perf_counter() - self._frame_start + self._preloaded_s
+        if image is not None: frame['frame_MB'] = image.nbytes/1e6
+        frame['max_rss_MB'] = maxRSS()
+        if self._profile is not None:
+            filename = os.path.join(self.profileDir,'profile_{:05d}'.format(len(self.frames)))
+            if self.profiler == 'cprofile':
+                self._profile.disable()
+                self._profile.dump_stats(filename+'.prof')
+            else:
+                self._profile.stop()
+                with open(filename+'.html','w') as out: out.write(self._profile.output_html())
+            self._profile = None
+        self.current = None
+        return self.addFrame(frame)
+
+    def preloaded(self,frame):
+        '''Keeps the stages of a frame that were timed by another photStats before the frame was started here (ie, reading it in a prefetch thread, see QAOP_pipeline.iterFrames()), so they are added in when startFrame() is called with the same name.'''
+        self.pending[frame['frame']] = frame
+
+    @contextlib.contextmanager
+    def resumeFrame(self,frame):
+        '''Carries on timing stages into a frame that was finished by another photStats (ie, in a worker process, for the part of the frame done back in the main process), and then adds it with addFrame().'''
+        self.current = frame
+        start = time.perf_counter()
+        try:
+            yield frame
+        finally:
+            self.current = None
+            frame['total_s'] += time.perf_counter() - start
+            self.addFrame(frame)
+
+    def addFrame(self,frame):
+        '''Adds a finished frame's dictionary, ie one timed by another photStats in a worker process (see QAOP_pipeline.measureFilesParallel()).'''
+        self.frames.append(frame)
+        if self.logPath is not None:
+            with open(self.logPath,'a') as log: log.write(json.dumps(frame)+'\n')
+        return frame
+
+    @contextlib.contextmanager
+    def stage(self,stage_name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if self.current is not None:
+                stages = self.current['stages']
+                stages[stage_name] = stages.get(stage_name,0.0) + time.perf_counter() - start
+
+    def addBytes(self,nbytes):
+        if self.current is not None: self.current['bytes_read'] += nbytes
+
+    def summary(self):
+        '''Returns a dictionary with the number of frames, the total time and bytes, and for each stage the total time, the mean time per frame, and the fraction of the total time it took.'''
+        total = sum(frame['total_s'] for frame in self.frames)
+        stages = {}
+        for frame in self.frames:
+            for stage_name,seconds in frame['stages'].items():
+                stages[stage_name] = stages.get(stage_name,0.0) + seconds
+        n = max(len(self.frames),1)
+        return {'frames':len(self.frames),'total_s':total,'bytes_read':sum(frame['bytes_read'] for frame in self.frames),
+                'stages':{stage_name:{'total_s':seconds,'mean_s':seconds/n,'fraction':seconds/total if total else 0.0}
+                          for stage_name,seconds in stages.items()}}
+
+def maxRSS():
+    #the peak memory of the process in MB, where the os lets us find it out
+    try:
+        import resource
+    except ImportError:
+        return None
+    import sys
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak/1e6 if sys.platform == 'darwin' else peak/1e3 #macs give bytes, linux gives kilobytes
+
+#end stats section -------
+
 class photInstance:
     '''A class designed to be created in an external notebook and allow the easy use of the functionality of this module. When being created it will need to have a file of the apertures. By default it will assume this file is in the same root directory, but a path may be specified by passing it as the "apertureFilePath" parameter. An alternate directory for the module to store results can also be specified by passing the parameter "resultDir", which defaults to a folder called "photometry" in the root directory. 
     
@@ -140,7 +502,7 @@ class photInstance:
     #annuli = []
     #master_history = []
     
-    def __init__(self,apertureFilePath='apertures.csv',resultDir='photometry',disableConfig=False):
+    def __init__(self,apertureFilePath='apertures.csv',resultDir='photometry',disableConfig=False,stats=None,recenterBox=None,maxShift=3.0,backgroundSigma=3.0,backgroundStatistic='median',calibration=None):
         
         if not disableConfig:
             #load paths from config
@@ -154,6 +516,7 @@ class photInstance:
             apertureFilePath = dataFilePath + apertureFilePath
             resultDir = dataFilePath + resultDir
         if disableConfig == 2:
+            dataFilePath = getConfigPaths()[1]
             apertureFilePath = dataFilePath + apertureFilePath
             resultDir = dataFilePath + resultDir
         #continue with init, using either the paths we had or the extended ones
@@ -164,6 +527,7 @@ class photInstance:
         #print()
         #if not os.listdir(resultDir+'/./').count(resultDir): os.mkdir(resultDir)
         #now that we know the directory exists, we can safely check how many master_table are in it :)
+        from astropy.table import Table
         master_count = os.listdir(resultDir).count('master_table.ecsv')
         if master_count:
             self.master_tab = Table.read(resultDir+'/master_table.ecsv')
@@ -180,7 +544,23 @@ class photInstance:
             self.master_history = []
         #and lastly, for if/when we need them again, we add the parameters as variables to the class
         self.apertureFilePath,self.resultDir = apertureFilePath, resultDir
-        #END INIT: Created self variables are [names,apertures,annuli,master_tab,master_history,apertureFilePath,resultDir]
+        #the stats are off (None) unless a photStats is passed in or enableStats() is called
+        self.stats = stats
+        #recentering is off unless a stamp size is given; see recenterApertures()
+        self.recenterBox,self.maxShift = recenterBox,maxShift
+        #how the annulus backgrounds are found; see annulusBackgrounds(). backgroundSigma=None gives the old unclipped median
+        self.backgroundSigma,self.backgroundStatistic = backgroundSigma,backgroundStatistic
+        #a QAOP_calibration.calibrator to apply to each raw frame as it is loaded, or None if the frames are already calibrated
+        self.calibration = calibration
+        #END INIT: Created self variables are [names,apertures,annuli,master_tab,master_history,apertureFilePath,resultDir,stats,recenterBox,maxShift,backgroundSigma,backgroundStatistic,calibration]
+
+    def enableStats(self,logPath=None,profiler=None,profileDir=None):
+        '''Turns on the timing of each stage of the photometry for every frame that is run from now on, and returns the photStats object they are recorded in (also kept as "stats"). See photStats for what logPath, profiler and profileDir do; by default the profiles go in the result directory.'''
+        self.stats = photStats(logPath=logPath,profiler=profiler,profileDir=self.resultDir if profileDir is None else profileDir)
+        return self.stats
+
+    def disableStats(self):
+        self.stats = None
     
     def createMasterTable(self):
         '''Uses the aperture names stored as "names" in the class instance to generate the master 3D table. Each row is an iteration of data addition (ie, a file that was read in and had photometry done on it), and each column is either an aperture, or, in the case of the first row, the datetime string for when the image was taken. The third dimension is acheived by storing a dictionary of the photometric results (raw sum, aperture area, local median, calculated local background, and adjusted sum) to each cell.
@@ -189,51 +569,86 @@ class photInstance:
         
         NOTE: due to the implementation of how rows are added and such, changes to the apertures file after the photometric process has begun can cause errors, so any created files for the photometry process should be deleted if the apertures change.
         '''
+        from astropy.table import Table
         col_names = np.hstack(('Time',self.names)) #create a list of columns: Time | name1 | name2 | ...
         col_dtypes = np.hstack((str,np.full(len(self.names),dict))) #set first column to a string and the rest to dict: str | dict | dict | ...
         MasterResultTab = Table(names=col_names,dtype=col_dtypes)
         return MasterResultTab
     
-    def runForFile(self,filepath):
+    def runForFile(self,filepath,save=True):
         '''The primary method for the class, and the intended connection point between users and the module. It takes in a filepath as a parameter, and then does its photometry work. The method returns the dictionary it uses to add a row to the master table. It is expected that this is generally discarded, but it is provided should an external user ever find a need for it. 
         The method calls the modules doForApertures() method using the aperture lists it has stored internally, after extracting the datetime of the observation and WCS info, as well as the image, from the file it was provided.
         
         The method will save the results as a new row in its internal master table and add an entry in the log file containing the filepath it used.
         
         NOTE: This method does not discriminate, and will re-add rows as many times as it is called, so make sure to clear/delete the backup if you would like to avoid repeats. (And/Or filter them out afterward)'''
-        image,wcs,img_time = loadImageAndWCS(filepath)
-        resultDict = doForApertures(image,self.names,self.apertures,self.annuli,wcs)
+        if self.stats is not None: self.stats.startFrame(filepath)
+        image,wcs,img_time,detector = loadFrame(filepath,stats=self.stats)
+        return self.runForImage(image,wcs,img_time,history_note="file:"+filepath,save=save,detector=detector)
+
+    def runForImage(self,image,wcs,img_time,history_note="",save=True,detector=None):
+        '''Does the same as runForFile(), but for an image (and its WCS and time) that has already been loaded in. This is what the pipeline module uses, since it reads the files ahead of time.
+        detector is the dictionary of gain, read noise and exposure time from getDetectorParams(); if it isn't given a gain of 1 and no read noise are assumed.'''
+        if detector is None: detector = {}
+        stats = self.stats
+        if stats is not None and stats.current is None: stats.startFrame(history_note)
+        resultDict = doForApertures(image,self.names,self.apertures,self.annuli,wcs,stats=stats,recenterBox=self.recenterBox,maxShift=self.maxShift,
+                                    backgroundSigma=self.backgroundSigma,backgroundStatistic=self.backgroundStatistic,
+                                    gain=detector.get('gain',1.0),readNoise=detector.get('readNoise',0.0),
+                                    calibration=self.calibration,exptime=detector.get('exptime',0.0))
         resultDict['Time'] = img_time
-        self.addRowToMaster(resultDict,history_note="file:"+filepath)
+        self.addRowToMaster(resultDict,history_note=history_note,save=save)
+        if stats is not None: stats.endFrame(image)
         return resultDict
-    
-    def addRowToMaster(self,row_to_add,history_note=""):
-        '''Adds a row to the internal master dictionary and an entry in the log. It is expecting to get a dictionary to add as the new row, with a named key/value pair for each column. It is untested what happens if you dont have this, but the author does not expect its a good thing at all, and did not integrate workarouds or checks originally because in their ideal world there are never errors and this is always being called by an instance with constant name/aperture lists.'''
+
+    def addRowToMaster(self,row_to_add,history_note="",save=True):
+        '''Adds a row to the internal master dictionary and an entry in the log. It is expecting to get a dictionary to add as the new row, with a named key/value pair for each column. It is untested what happens if you dont have this, but the author does not expect its a good thing at all, and did not integrate workarouds or checks originally because in their ideal world there are never errors and this is always being called by an instance with constant name/aperture lists.
+        Rewriting the master table file gets slower the bigger it is, so when lots of rows are being added at once save=False can be passed and saveMaster() called every so often instead. The log is always written, but since each entry starts with its row number, processedFiles() can tell which entries actually made it into the saved table.'''
         self.master_history.append(str(len(self.master_tab))+':'+history_note) #append a new status message to the log list
         self.master_tab.add_row(row_to_add) #add the row! it should have the right columns and column names otherwise it complains and dies
         #and lastly save the updated table
-        self.master_tab.write(self.resultDir+'/master_table.ecsv',format='ascii.ecsv',overwrite=True)#save the new table
-        with open(self.resultDir+'/master_log.txt','a') as log: #open in "append" mode
-            log.write('\r\n'+self.master_history[-1]) #write the last item (which we added 4 lines above) to the file
-            
+        if save: self.saveMaster()
+        with timedStage(self.stats,'log'):
+            with open(self.resultDir+'/master_log.txt','a') as log: #open in "append" mode
+                log.write('\r\n'+self.master_history[-1]) #write the last item (which we added 4 lines above) to the file
+
+    def saveMaster(self):
+        with timedStage(self.stats,'save_table'):
+            self.master_tab.write(self.resultDir+'/master_table.ecsv',format='ascii.ecsv',overwrite=True)#save the new table
 
-    def exportMasterAsTables(self,resultValueNames=["aperture_raw_sum","aperture_area","annulus_median","background_to_subtract","aperture_sum"]):
+    def processedFiles(self):
+        '''Returns the list of filepaths that have had their results added to the master table, found by reading back the "file:" entries in the log. Entries whose row number is past the end of the table (ie, they were logged but the table wasn't saved before a crash) are left out, so those files will be picked up again.'''
+        processed = []
+        for entry in self.master_history:
+            entry = entry.strip()
+            if entry == "!! Master Buffer Cleared !!": processed = []
+            parts = entry.split(':',2)
+            if len(parts) < 3 or parts[1] != 'file' or not parts[0].isdigit(): continue
+            if int(parts[0]) < len(self.master_tab): processed.append(parts[2])
+        return processed
+
+
+    def masterAsArray(self,resultValueNames=resultValueNames):
+        '''Unpacks the 3D Master table into plain arrays in a single pass. It returns the array of time strings (one per row), and a float array with shape (row/time, source, resultValue), where the sources are in the order of "names" and the values in the order of resultValueNames.
+        All of the export methods are built on top of this, so it is also the quickest way to get the data out for use elsewhere.'''
+        times = np.asarray(self.master_tab['Time'],dtype=str)
+        values = np.zeros((len(times),len(self.names),len(resultValueNames)))
+        for s,source_name in enumerate(self.names):
+            #cells from before a value existed (ie, aperture_sum_err in older tables) come out as nan
+            column = [[cell.get(value_name,np.nan) for value_name in resultValueNames] for cell in self.master_tab[source_name]]
+            values[:,s,:] = np.reshape(column,(len(times),len(resultValueNames)))
+        return times, values
+
+    def exportMasterAsTables(self,resultValueNames=resultValueNames):
         '''This method will take the 3D (V:time/file,H:name/source,D:resultValue) Master table and unpack it into tables for each source. (ie, V,D slices)
         These new tables are saved to the (default, or specified alternative) "photometry" folder. See also the other export methods if a different data slice is desired. If changes are ever made to what "depth values" are used/desired, that list is defined as a default property and can be changed, though this is untested.'''
-        time_column = self.master_tab['Time']
+        from astropy.table import Table
+        times, values = self.masterAsArray(resultValueNames)
         col_names = np.hstack(('time',resultValueNames)) #we want time, and a column for each value
-        col_dtypes = np.hstack((str,np.full(len(resultValueNames),float))) #first column is a string, the rest are numbers
-        
-        for source_name in self.names:
-            master_table_column = self.master_tab[source_name]
-            tempTable = Table(names=col_names,dtype=col_dtypes)
-            for r in range(len(time_column)):
-                new_row = master_table_column[r] #add the r-th cell's values to the new row
-                new_row['time'] = time_column[r] #add the r-th time to the new row
-                tempTable.add_row(new_row) #and add the new row
-            #then we need to save this table
+        for s,source_name in enumerate(self.names):
+            #the V,D slice for this source is values[:,s,:], so each column of the new table is just a column of that
+            tempTable = Table([times]+[values[:,s,v] for v in range(len(resultValueNames))],names=col_names)
             tempTable.write(self.resultDir+'/'+source_name+'.ecsv',format='ascii.ecsv',overwrite=True)
-            #and then we repeat that for each of the sources
         #Done source-wise export
         
     def exportMasterAsSimple(self):
@@ -241,43 +656,63 @@ class photInstance:
         
         Unlike the other two export functions, note that this one returns its table. This is so that you can get the table externally and make use of it without haveing to load in the exported file.
         '''
+        from astropy.table import Table
+        times, values = self.masterAsArray(["aperture_sum"])
         col_names = np.hstack(('time',self.names))#we want time, and a column for each of the names. 
-        #Note this is technically the result of the createMasterTable function that I could have reused, except we want different data types
-        col_dtypes = np.hstack((str,np.full(len(self.names),float))) #set first column to a string and the rest to floats
-        
-        new_table = Table(names=col_names,dtype=col_dtypes)
-        #now we just need to iterate through every row (and cell) and add those to this table
-        
-        for r in range(len(self.master_tab)):
-            old_row = self.master_tab[r]
-            new_row = {'time':old_row['Time']} #create a dictionary with time named
-            
-            for srcname in self.names:
-                srcsum = old_row[srcname]['aperture_sum']
-                new_row[srcname] = srcsum #add the new item to the dictionary
-            
-            new_table.add_row(new_row)
-        
+        new_table = Table([times]+[values[:,s,0] for s in range(len(self.names))],names=col_names)
         #now we need to save the table to a file
         new_table.write(self.resultDir+'/'+'simple'+'.ecsv',format='ascii.ecsv',overwrite=True)
         return new_table #done simple export
         
-    def exportMasterAsValues(self,resultValueNames=["aperture_raw_sum","aperture_area","annulus_median","background_to_subtract","aperture_sum"]):
+    def exportMasterAsValues(self,resultValueNames=resultValueNames):
         '''This export method creates a matched V/H table for each of the layers depthwise (ie a 'raw_sum' table, a 'area' table, etc). 
         It works in exactly the same way as the simple export but with more values. See that function for a more readable understanding of whats going on in the source code.'''
+        from astropy.table import Table
+        times, values = self.masterAsArray(resultValueNames)
         col_names = np.hstack(('time',self.names))#we want time, and a column for each of the names. 
-        col_dtypes = np.hstack((str,np.full(len(self.names),float))) #set first column to a string and the rest to floats
-        for value_name in resultValueNames:
-            new_table = Table(names=col_names,dtype=col_dtypes) #create a table for this value
-            for r in range(len(self.master_tab)):
-                old_row = self.master_tab[r]
-                new_row = {'time':old_row['Time']} #create a dictionary with time named to start
-                for srcname in self.names: #now loop through and add each column to the dictionary
-                    srcsum = old_row[srcname][value_name]
-                    new_row[srcname] = srcsum #add the new item to the dictionary
-                new_table.add_row(new_row)
+        for v,value_name in enumerate(resultValueNames):
+            new_table = Table([times]+[values[:,s,v] for s in range(len(self.names))],names=col_names) #create a table for this value
             new_table.write(self.resultDir+'/'+value_name+'.ecsv',format='ascii.ecsv',overwrite=True) #save the table for this value to a file
         #done Value-wise export
+
+    #The binary exports write the whole (time, source, value) cube in one go, rather than as lots of little ascii tables.
+    # They are much faster to write and to read back in, see loadExportedValues() for reading them.
+    def exportMasterAsNPZ(self,filename='photometry.npz',resultValueNames=resultValueNames,compress=True):
+        '''Saves the time strings, source names, value names and the value cube from masterAsArray() to a single numpy .npz file. Returns the path it was written to.'''
+        times, values = self.masterAsArray(resultValueNames)
+        filepath = self.resultDir+'/'+filename
+        save = np.savez_compressed if compress else np.savez
+        save(filepath,time=times,names=np.asarray(self.names,dtype=str),quantities=np.asarray(resultValueNames,dtype=str),values=values)
+        return filepath
+
+    def exportMasterAsHDF5(self,filename='photometry.h5',resultValueNames=resultValueNames,compress=True):
+        '''Saves the same arrays as exportMasterAsNPZ() as datasets in an HDF5 file. This needs the h5py package.'''
+        import h5py #only needed here, so we don't make everyone install it
+        times, values = self.masterAsArray(resultValueNames)
+        filepath = self.resultDir+'/'+filename
+        compression = 'gzip' if compress else None
+        with h5py.File(filepath,'w') as h5:
+            h5.create_dataset('time',data=np.char.encode(times,'ascii'))
+            h5.create_dataset('names',data=np.char.encode(np.asarray(self.names,dtype=str),'utf-8'))
+            h5.create_dataset('quantities',data=np.char.encode(np.asarray(resultValueNames,dtype=str),'ascii'))
+            h5.create_dataset('values',data=values,compression=compression,chunks=True if len(times) else None)
+        return filepath
+
+    def exportMasterAsParquet(self,filename='photometry.parquet',resultValueNames=resultValueNames,compression='snappy'):
+        '''Saves the results as a "long" parquet table, with one row for each (time, source) pair and the columns
+        time | name | value1 | value2 | ...
+        which is the layout most dataframe tools expect. This needs the pyarrow package. compression can be any codec pyarrow knows ('snappy','zstd','gzip') or None.'''
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        times, values = self.masterAsArray(resultValueNames)
+        n_times, n_sources = values.shape[0], values.shape[1]
+        columns = {'time':np.repeat(times,n_sources),'name':np.tile(np.asarray(self.names,dtype=str),n_times)}
+        flat = values.reshape(n_times*n_sources,len(resultValueNames))
+        for v,value_name in enumerate(resultValueNames):
+            columns[value_name] = flat[:,v]
+        filepath = self.resultDir+'/'+filename
+        pq.write_table(pa.table(columns),filepath,compression=compression)
+        return filepath
         
     def clearMasterBuffer(self):
         self.MasterResultTab = self.createMasterTable()
@@ -286,4 +721,72 @@ class photInstance:
         self.master_history.append("!! Master Buffer Cleared !!") #append a new status message to the log list
         with open(self.resultDir+'/master_log.txt','a') as log: #open in "append" mode
             log.write('\r\n'+self.master_history[-1])
-        
\ No newline at end of file
+        
+
+
+class photSession:
+    '''Holds several photInstance objects (ie, different targets, or different aperture sets for the same target) that are all being run on the same frames, so that each frame only has to be read and decoded once.
+    Each target is added with addTarget(), and keeps its own apertures, results directory, master table and log exactly as if it was run on its own. runForFile() then reads the frame once (with loadFrame()) and hands the same array to every target, so adding another target to a night only costs its photometry.
+    If a calibration is given to the session, it is applied to the whole frame once and the calibrated frame is shared (so the targets themselves shouldn't also be given it).
+    A session has the same runForImage()/saveMaster()/processedFiles() methods as a photInstance, so it can be passed to the functions in QAOP_pipeline in place of one; the results it gives back are then a dictionary of each target's result dictionary. For differential magnitudes, give the pipeline a target and comparisons for each session target (see QAOP_pipeline.differentialPoint()).'''
+
+    def __init__(self,calibration=None,stats=None):
+        self.targets = {}
+        self.done = {} #the set of files each target already has in its master table, so they aren't added twice
+        self.calibration = calibration
+        self.stats = stats
+
+    def addTarget(self,target_name,apertureFilePath='apertures.csv',resultDir='photometry',**kwargs):
+        '''Makes a photInstance for the target (any extra arguments are passed on to it, ie disableConfig), adds it to the session and returns it. An existing photInstance can also be added directly with addInstance().'''
+        return self.addInstance(target_name,photInstance(apertureFilePath,resultDir,**kwargs))
+
+    def addInstance(self,target_name,inst):
+        self.targets[target_name] = inst
+        self.done[target_name] = set(inst.processedFiles())
+        return inst
+
+    def runForFile(self,filepath,save=True):
+        '''Reads the frame once and does the photometry for every target on it. Returns a dictionary of each target's result dictionary (targets that already had this file are left out).'''
+        if self.stats is not None: self.stats.startFrame(filepath)
+        image,wcs,img_time,detector = loadFrame(filepath,stats=self.stats)
+        return self.runForImage(image,wcs,img_time,history_note="file:"+filepath,save=save,detector=detector)
+
+    def runForImage(self,image,wcs,img_time,history_note="",save=True,detector=None):
+        if detector is None: detector = {}
+        if self.stats is not None and self.stats.current is None: self.stats.startFrame(history_note)
+        if self.calibration is not None:
+            with timedStage(self.stats,'calibrate'):
+                image = self.calibration.apply(image,detector.get('exptime',0.0))
+        filepath = history_note[len("file:"):] if history_note.startswith("file:") else None
+        results = {}
+        for target_name,inst in self.targets.items():
+            if filepath is not None and filepath in self.done[target_name]: continue
+            results[target_name] = inst.runForImage(image,wcs,img_time,history_note=history_note,save=save,detector=detector)
+            if filepath is not None: self.done[target_name].add(filepath)
+        if self.stats is not None: self.stats.endFrame(image)
+        return results
+
+    def runForFiles(self,filepaths,checkpointEvery=50):
+        '''Runs every target over a list of files (ie, several nights' worth), saving the master tables every checkpointEvery frames and at the end.'''
+        for f,filepath in enumerate(filepaths):
+            self.runForFile(filepath,save=bool(checkpointEvery) and (f+1) % checkpointEvery == 0)
+        self.saveMaster()
+
+    def saveMaster(self):
+        for inst in self.targets.values(): inst.saveMaster()
+
+    def processedFiles(self):
+        '''Returns the files that every target has already done, which are the ones the pipeline can skip entirely.'''
+        if not self.targets: return []
+        done = set.intersection(*self.done.values())
+        return sorted(done)
+
+def loadExportedValues(filepath):
+    '''Reads back a file written by photInstance.exportMasterAsNPZ() or exportMasterAsHDF5(), and returns (times, names, quantities, values) where values is the (time, source, quantity) float array.'''
+    if filepath.endswith('.h5') or filepath.endswith('.hdf5'):
+        import h5py
+        with h5py.File(filepath,'r') as h5:
+            return (np.char.decode(h5['time'][:],'ascii'),np.char.decode(h5['names'][:],'utf-8'),
+                    np.char.decode(h5['quantities'][:],'ascii'),h5['values'][:])
+    with np.load(filepath) as npz:
+        return npz['time'], npz['names'], npz['quantities'], npz['values']
@@ -0,0 +1,315 @@
+#This module chains the photometry steps together as generators, so that a whole night of (already plate solved) frames
+# can be reduced in a single pass. Each stage pulls one frame at a time from the stage before it, so only a few frames
+# are ever held in memory, and the results go straight into a photInstance's master table and out as light curve points.
+#
+#The usual way to use it is:
+#    inst = photInstance()
+#    for img_time, resultDict, dmag in runPipeline(inst, dataFilePath+'output/', target='sA', comparisons=['sB','sC']):
+#        ...
+#but each of the stages can also be used on their own.
+
+import os
+import fnmatch
+import threading
+import time
+import queue
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    from QAOP_photometry import loadFrame, loadAperturesFromFile, doForApertures, photStats
+    from QAOP_utils import diffMag
+except ModuleNotFoundError:
+    from QAOP.QAOP_photometry import loadFrame, loadAperturesFromFile, doForApertures, photStats
+    from QAOP.QAOP_utils import diffMag
+
+
+def iterFramePaths(directory,pattern='*.fits',skip=()):
+    '''Yields the paths of the files in the directory that match the pattern, in name order (which is the order astrometry saves them in: 001.fits, 002.fits, ...). Any paths in "skip" are left out, which is how already processed files are avoided.'''
+    skip = set(skip)
+    filenames = sorted(entry.name for entry in os.scandir(directory) if entry.is_file() and fnmatch.fnmatch(entry.name,pattern))
+    for filename in filenames:
+        filepath = os.path.join(directory,filename)
+        if filepath in skip: continue
+        yield filepath
+
+def iterFrames(filepaths,onError=None,stats=None):
+    '''Loads each of the files lazily, yielding (filepath, image, wcs, img_time, detector) for one file at a time, where detector is the gain and read noise from the header.
+    If onError is given, a file that can't be read is skipped and onError(filepath, error) is called, instead of the error ending the iteration.
+    If stats (a photStats) is given, the loading of each file is timed too. Since this usually runs ahead in a prefetch() thread, each file gets its own photStats, which is handed to stats.preloaded() and added to that file's frame when measureFrames() starts it.'''
+    for filepath in filepaths:
+        try:
+            if stats is None:
+                image,wcs,img_time,detector = loadFrame(filepath)
+            else:
+                loadStats = photStats()
+                loadStats.startFrame(filepath)
+                image,wcs,img_time,detector = loadFrame(filepath,stats=loadStats)
+                stats.preloaded(loadStats.current)
+        except Exception as e:
+            if onError is None: raise
+            onError(filepath,e)
+            continue
+        yield filepath,image,wcs,img_time,detector
+
+def prefetch(iterable,depth=2):
+    '''Runs the given iterable in a background thread, keeping at most "depth" items ready ahead of whoever is consuming them. This lets the next frames be read off the disk while the photometry is done on the current one.
+    The queue between them is bounded, so if the photometry is slower than the reading, the reading waits (rather than filling up the memory with frames).'''
+    if depth <= 0:
+        yield from iterable
+        return
+    buffer = queue.Queue(maxsize=depth)
+    finished = object() #a unique marker for the end of the iterable
+    stop = threading.Event()
+
+    def producer():
+        try:
+            for item in iterable:
+                while not stop.is_set():
+                    try:
+                        buffer.put((item,None),timeout=0.1)
+                        break
+                    except queue.Full:
+                        continue
+                if stop.is_set(): return
+            buffer.put((finished,None))
+        except Exception as e: #hand the error over so that it is raised where the frames are being used
+            buffer.put((finished,e))
+
+    thread = threading.Thread(target=producer,daemon=True)
+    thread.start()
+    try:
+        while True:
+            item,error = buffer.get()
+            if item is finished:
+                if error is not None: raise error
+                return
+            yield item
+    finally:
+        #if the consumer stops early, let the producer thread finish up instead of blocking forever
+        stop.set()
+
+def measureFrames(inst,frames,checkpointEvery=50):
+    '''Does the photometry for each (filepath, image, wcs, img_time, detector) in frames using the photInstance "inst", adding each result to its master table. Yields (img_time, resultDict) as each frame is done.
+    The master table is saved every "checkpointEvery" frames and once more at the end, rather than after every single frame.'''
+    unsaved = 0
+    try:
+        for filepath,image,wcs,img_time,detector in frames:
+            if inst.stats is not None: inst.stats.startFrame(filepath) #the same frame name as runForFile() and the parallel workers use
+            resultDict = inst.runForImage(image,wcs,img_time,history_note="file:"+filepath,save=False,detector=detector)
+            unsaved += 1
+            if checkpointEvery and unsaved >= checkpointEvery:
+                inst.saveMaster()
+                unsaved = 0
+            yield img_time,resultDict
+    finally:
+        if unsaved: inst.saveMaster()
+
+def differentialPoint(resultDict,target,comparisons,value='aperture_sum'):
+    '''Returns the differential magnitude of the target against the summed flux of the comparison stars for a single frame's results.
+    For the results of a photSession (a result dictionary for each session target), target and comparisons are dictionaries keyed by the session's target names, ie target={'WASP-12':'sA'}, comparisons={'WASP-12':['sB','sC']}, and a dictionary of differential magnitudes is returned (leaving out session targets that had already done the frame).'''
+    if isinstance(target,dict):
+        return {name:differentialPoint(resultDict[name],target[name],comparisons[name],value=value) for name in target if name in resultDict}
+    comparisonFlux = np.sum([resultDict[name][value] for name in comparisons])
+    return diffMag(resultDict[target][value],comparisonFlux)
+
+def differentialLightCurve(records,target,comparisons,value='aperture_sum'):
+    '''Takes the (img_time, resultDict) records from measureFrames() and yields (img_time, resultDict, differential magnitude).'''
+    for img_time,resultDict in records:
+        yield img_time,resultDict,differentialPoint(resultDict,target,comparisons,value=value)
+
+def checkTargets(inst,target,comparisons):
+    #a photSession gives a result dictionary per session target, so it needs a target and comparisons for each of them
+    if target is None or not hasattr(inst,'targets'): return
+    if not isinstance(target,dict) or not isinstance(comparisons,dict):
+        raise ValueError("For a photSession, target and comparisons should be dictionaries keyed by the session's target names, ie target={'WASP-12':'sA'}, comparisons={'WASP-12':['sB','sC']}")
+    unknown = [name for name in target if name not in inst.targets or name not in comparisons]
+    if unknown: raise ValueError("No session target or no comparisons for "+str(unknown)+"; the session's targets are "+str(list(inst.targets)))
+
+def runPipeline(inst,directory,target=None,comparisons=(),pattern='*.fits',prefetchDepth=2,checkpointEvery=50,resume=True):
+    '''Chains all of the stages together: finds the frames in directory, reads them ahead in the background, does the photometry with the photInstance "inst", and yields (img_time, resultDict, differential magnitude) for each frame.
+    If no target is given, the differential magnitude is None. If resume is True, the files that are already in inst's master table are skipped, so an interrupted night can just be run again.
+    inst can also be a photSession, in which case target and comparisons are dictionaries (see differentialPoint()).
+    Nothing happens until the generator is iterated over; use collectLightCurve() to run it all and get arrays back.'''
+    checkTargets(inst,target,comparisons)
+    skip = inst.processedFiles() if resume else ()
+    frames = prefetch(iterFrames(iterFramePaths(directory,pattern=pattern,skip=skip),stats=inst.stats),depth=prefetchDepth)
+    records = measureFrames(inst,frames,checkpointEvery=checkpointEvery)
+    if target is None:
+        for img_time,resultDict in records:
+            yield img_time,resultDict,None
+    else:
+        yield from differentialLightCurve(records,target,comparisons)
+
+#Parallel section ---------
+#The photometry of one frame doesn't depend on any other, so the frames can be spread over several processes. Each worker
+# loads the apertures once and then reads and measures whole frames, sending back only the results; the master table,
+# which has to stay in order, is only ever touched by the main process.
+
+workerState = {}
+
+def _initWorker(apertureFilePath,options):
+    names,apertures,annuli = loadAperturesFromFile(apertureFilePath)
+    workerState.update(names=names,apertures=apertures,annuli=annuli,options=options)
+
+def _measureFile(filepath):
+    stats = photStats()
+    stats.startFrame(filepath)
+    image,wcs,img_time,detector = loadFrame(filepath,stats=stats)
+    resultDict = doForApertures(image,workerState['names'],workerState['apertures'],workerState['annuli'],wcs,stats=stats,
+                                gain=detector['gain'],readNoise=detector['readNoise'],exptime=detector['exptime'],**workerState['options'])
+    resultDict['Time'] = img_time
+    return filepath,resultDict,stats.endFrame(image)
+
+def measureFilesParallel(inst,filepaths,workers=None,checkpointEvery=50):
+    '''Does the photometry for each of the files over a pool of "workers" processes (one per cpu by default), with the apertures and settings of the photInstance "inst", and adds the results to inst's master table in the same order as the files. Yields (img_time, resultDict) as each frame is added, the same as measureFrames().
+    If inst has stats turned on, each frame's stage timings from the workers are added to them.'''
+    options = {'recenterBox':inst.recenterBox,'maxShift':inst.maxShift,'backgroundSigma':inst.backgroundSigma,
+               'backgroundStatistic':inst.backgroundStatistic,'calibration':inst.calibration}
+    pool = ProcessPoolExecutor(max_workers=workers,initializer=_initWorker,initargs=(inst.apertureFilePath,options))
+    unsaved = 0
+    try:
+        for filepath,resultDict,frame in pool.map(_measureFile,filepaths):
+            if inst.stats is None:
+                inst.addRowToMaster(resultDict,history_note="file:"+filepath,save=False)
+            else:
+                with inst.stats.resumeFrame(frame): #so the log stage is counted the same as when it's run serially
+                    inst.addRowToMaster(resultDict,history_note="file:"+filepath,save=False)
+            unsaved += 1
+            if checkpointEvery and unsaved >= checkpointEvery:
+                inst.saveMaster()
+                unsaved = 0
+            yield resultDict['Time'],resultDict
+    finally:
+        #if the consumer stops early, don't start on any of the frames that are still waiting
+        pool.shutdown(wait=True,cancel_futures=True)
+        if unsaved: inst.saveMaster()
+
+#Watch mode ---------
+#Instead of waiting for the end of the night, these watch the data directory and reduce each frame as soon as the
+# telescope has finished writing it.
+
+FITS_BLOCK = 2880 #FITS files are always written in whole blocks of this many bytes
+FITS_CARD = 80
+
+def headerValue(card):
+    #the value of a header card as an int (the only kind the sizes need), or None
+    value = card[10:].split('/')[0].strip()
+    try:
+        return int(value)
+    except ValueError:
+        return None
+
+def fitsComplete(filepath):
+    '''Works out from the headers whether a FITS file has been completely written: each HDU's header says how big its data is (NAXISn * |BITPIX|/8, padded to whole blocks), so the file is complete once its last HDU's data reaches the end of the file.
+    Returns False if a header is cut off, or the file stops partway through some data.'''
+    with open(filepath,'rb') as fitsFile:
+        size = os.fstat(fitsFile.fileno()).st_size
+        position = 0
+        while position < size:
+            cards = {}
+            while 'END' not in cards:
+                block = fitsFile.read(FITS_BLOCK)
+                if len(block) < FITS_BLOCK: return False #the header isn't all there yet
+                for i in range(0,FITS_BLOCK,FITS_CARD):
+                    card = block[i:i+FITS_CARD].decode('ascii','replace')
+                    keyword = card[:8].strip()
+                    if keyword == 'END':
+                        cards['END'] = None
+                        break
+                    if card[8:10] == '= ' and keyword not in cards: cards[keyword] = headerValue(card)
+            naxis = cards.get('NAXIS') or 0
+            axes = [cards.get('NAXIS'+str(n)) or 0 for n in range(1,naxis+1)]
+            if axes and axes[0] == 0 and 'GROUPS' in cards: axes = axes[1:] #random groups don't count NAXIS1
+            pixels = int(np.prod(axes,dtype=np.int64)) if axes else 0
+            nbytes = abs(cards.get('BITPIX') or 8)//8*(cards.get('GCOUNT') or 1)*((cards.get('PCOUNT') or 0) + pixels)
+            position = fitsFile.tell() + -(-nbytes//FITS_BLOCK)*FITS_BLOCK #the data is padded out to a whole block
+            if position > size: return False
+            fitsFile.seek(position)
+        return position == size
+
+def watchFramePaths(directory,pattern='*.fits',skip=(),pollInterval=0.5,stableChecks=1,idleTimeout=None,stop=None,retry=None):
+    '''Watches the directory and yields the path of each new file matching the pattern once it has been fully written. A file counts as fully written when it is as long as its headers say it should be (see fitsComplete()), and its size hasn't changed for "stableChecks" polls in a row.
+    retry can be a list that whoever is using the paths adds a path back onto if it couldn't be read after all; it is then watched again and yielded on a later poll.
+    It carries on forever unless "idleTimeout" (seconds without a new file) runs out, or "stop" (a threading.Event) is set.'''
+    seen = set(skip)
+    sizes,unchanged = {},{}
+    lastNew = time.monotonic()
+    while stop is None or not stop.is_set():
+        while retry:
+            seen.discard(retry.pop())
+        for entry in sorted(os.scandir(directory),key=lambda e: e.name):
+            if not entry.is_file() or not fnmatch.fnmatch(entry.name,pattern): continue
+            filepath = os.path.join(directory,entry.name)
+            if filepath in seen: continue
+            try:
+                size = entry.stat().st_size
+            except FileNotFoundError: #it was moved away while we were looking
+                continue
+            if size > 0 and size % FITS_BLOCK == 0 and sizes.get(filepath) == size:
+                unchanged[filepath] = unchanged.get(filepath,0) + 1
+            else:
+                unchanged[filepath] = 0
+            sizes[filepath] = size
+            if unchanged[filepath] >= stableChecks:
+                try:
+                    complete = fitsComplete(filepath)
+                except OSError:
+                    continue
+                if not complete: #ie, the telescope paused for a while partway through writing it
+                    unchanged[filepath] = 0
+                    continue
+                seen.add(filepath)
+                del sizes[filepath],unchanged[filepath]
+                lastNew = time.monotonic()
+                yield filepath
+        if idleTimeout is not None and time.monotonic() - lastNew > idleTimeout: return
+        if stop is None: time.sleep(pollInterval)
+        else: stop.wait(pollInterval)
+
+def iterSolvedFrames(filepaths,solver=None,onError=None,stats=None):
+    '''The same as iterFrames(), but for frames that might not have been plate solved yet. If a frame has no celestial WCS in its header, "solver" (a function taking the filepath and returning a WCS) is called to get one. If there is no solver, the last good WCS is reused, since the telescope is tracking the same field all night.
+    Frames that can't be given a WCS at all are skipped.'''
+    lastWCS = None
+    for filepath,image,wcs,img_time,detector in iterFrames(filepaths,onError=onError,stats=stats):
+        if not wcs.has_celestial:
+            if solver is not None: wcs = solver(filepath)
+            elif lastWCS is not None: wcs = lastWCS
+            else:
+                print("No WCS for",filepath,"and nothing to reuse yet, skipping it")
+                continue
+        lastWCS = wcs
+        yield filepath,image,wcs,img_time,detector
+
+def runWatch(inst,directory,target=None,comparisons=(),pattern='*.fits',solver=None,pollInterval=0.5,stableChecks=1,idleTimeout=None,stop=None,checkpointEvery=1,resume=True,maxRetries=5):
+    '''The live version of runPipeline(). It watches the directory and yields (img_time, resultDict, differential magnitude) for each new frame a moment after the telescope finishes writing it, adding the results to inst's master table as it goes.
+    See watchFramePaths() for how it decides a file is done, and iterSolvedFrames() for how frames without a WCS are handled. A frame that can't be read is tried again on a later poll (up to maxRetries times) rather than stopping the night's reduction.
+    Stop it by setting "stop", letting "idleTimeout" run out, or just breaking out of the loop.'''
+    checkTargets(inst,target,comparisons)
+    skip = inst.processedFiles() if resume else ()
+    retry,attempts = [],{}
+    def retryLater(filepath,error):
+        attempts[filepath] = attempts.get(filepath,0) + 1
+        if attempts[filepath] > maxRetries:
+            print("Couldn't read",filepath,"after",maxRetries,"retries, skipping it:",error)
+            return
+        print("Couldn't read",filepath,"yet, it will be tried again:",error)
+        retry.append(filepath)
+    filepaths = watchFramePaths(directory,pattern=pattern,skip=skip,pollInterval=pollInterval,stableChecks=stableChecks,idleTimeout=idleTimeout,stop=stop,retry=retry)
+    records = measureFrames(inst,iterSolvedFrames(filepaths,solver=solver,onError=retryLater,stats=inst.stats),checkpointEvery=checkpointEvery)
+    if target is None:
+        for img_time,resultDict in records:
+            yield img_time,resultDict,None
+    else:
+        yield from differentialLightCurve(records,target,comparisons)
+
+def collectLightCurve(pipeline):
+    '''Runs a pipeline from runPipeline() to the end, and returns the array of time strings and the array of differential magnitudes (for a photSession, a dictionary of an array for each target, with nan where a target skipped a frame).'''
+    times,dmags = [],[]
+    for img_time,resultDict,dmag in pipeline:
+        times.append(img_time)
+        dmags.append(np.nan if dmag is None else dmag)
+    names = sorted({name for dmag in dmags if isinstance(dmag,dict) for name in dmag})
+    if names:
+        return np.asarray(times,dtype=str),{name:np.array([dmag.get(name,np.nan) for dmag in dmags],dtype=float) for name in names}
+    return np.asarray(times,dtype=str),np.asarray(dmags,dtype=float)
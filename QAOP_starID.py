@@ -1,5 +1,6 @@
 #import os
 import numpy as np
+from collections import deque
 # from astropy.table import Table
 # from astropy.io import fits
 # from astropy.wcs import WCS
@@ -20,7 +21,12 @@ try:
     from QAOP_utils import readConfigFile
 except ModuleNotFoundError:
     from QAOP.QAOP_utils import readConfigFile
-codeFilePath,dataFilePath,errormsg = readConfigFile()
+
+def __getattr__(name):
+    #the config file is only read if one of its paths is asked for, rather than every time the module is imported
+    if name in ('codeFilePath','dataFilePath','errormsg'):
+        return readConfigFile()[('codeFilePath','dataFilePath','errormsg').index(name)]
+    raise AttributeError("module "+repr(__name__)+" has no attribute "+repr(name))
 
 
 #Autonamer section ---------
@@ -35,19 +41,39 @@ class autonamer:
         self.counter += 1
         return self.name(self.counter)
     
+    def names(self,count):
+        '''Returns the next "count" names as a numpy string array, the same as calling nextName() that many times.'''
+        nameInts = np.arange(self.counter+1,self.counter+count+1)
+        self.counter += count
+        return self.nameArr(nameInts)
+
+    def digitSymbols(self):
+        #the symbol for each digit value 1..capacity, ie 'A'..'Z' for the charnamer
+        return np.array([str(self.outfmt(self.start + d)) for d in range(1,self.capacity+1)])
+
     def name(self,nameInt):
-        lastDigit = 0 + nameInt #we do 0 + a number to verify we have a new object that's a copy
-        firstDigit = 0
-        while lastDigit > self.capacity:
-            firstDigit += 1
-            lastDigit -= self.capacity
-            #print("roll",firstDigit,lastDigit)
-        if firstDigit > self.capacity: raise IndexError("Two Digit Naming Capacity Limit ("+str((self.capacity+1)*self.capacity) +") Exceeded: " + str(nameInt))
-        name = 's'
-        if firstDigit > 0:
-            name = name + str(self.outfmt(self.start + firstDigit))
-        name = name + str(self.outfmt(self.start + lastDigit))
-        return name
+        #The names are the number written in bijective base-"capacity" (digits run 1..capacity, there is no zero),
+        # so for the charnamer it goes A..Z, AA..AZ, BA.. ZZ, AAA.. and so on with no upper limit.
+        if nameInt < 1: raise IndexError("Names start at 1: " + str(nameInt))
+        name = ''
+        remaining = nameInt
+        while remaining > 0:
+            digit = (remaining - 1) % self.capacity + 1
+            name = str(self.outfmt(self.start + digit)) + name
+            remaining = (remaining - digit) // self.capacity
+        return 's' + name
+
+    def nameArr(self,nameInts):
+        '''The array version of name(); it does one numpy pass per digit rather than one python loop per name.'''
+        remaining = np.asarray(nameInts,dtype=np.int64)
+        if np.any(remaining < 1): raise IndexError("Names start at 1")
+        symbols = np.hstack(('',self.digitSymbols())) #index 0 is used for digits past the front of shorter names
+        names = np.full(remaining.shape,'',dtype=object)
+        while np.any(remaining > 0):
+            digit = np.where(remaining > 0,(remaining - 1) % self.capacity + 1,0)
+            names = symbols[digit].astype(object) + names
+            remaining = (remaining - digit) // self.capacity
+        return ('s' + names).astype(str)
 
 def charnamer():
     return autonamer(fmt=chr,startindex=64,capacity=26)
@@ -57,6 +83,185 @@ def intnamer():
 #end autonamer section -------
 
 
+#Catalog matching section ---------
+#Matches the stars detected in a frame (ie, by find_peaks) to the named stars in the aperture catalog. The catalog is put
+# in a KD-tree of unit vectors on the sphere, so each frame's detections are matched in O(N log M) rather than by
+# checking every detection against every star, and it works the same right up to the poles and across RA=0.
+
+def radecToUnit(ra,dec):
+    '''Converts ra and dec (in degrees) into an (N,3) array of unit vectors.'''
+    ra,dec = np.radians(np.atleast_1d(ra)),np.radians(np.atleast_1d(dec))
+    cosdec = np.cos(dec)
+    return np.column_stack((cosdec*np.cos(ra),cosdec*np.sin(ra),np.sin(dec)))
+
+def arcsecToChord(arcsec):
+    #the straight line distance between two unit vectors that are this far apart on the sky
+    return 2*np.sin(np.radians(np.asarray(arcsec)/3600)/2)
+
+def chordToArcsec(chord):
+    return np.degrees(2*np.arcsin(np.clip(np.asarray(chord)/2,0,1)))*3600
+
+class skyIndex:
+    '''A spatial index of the catalog stars, for matching detections to them. Make it from the lists that loadAperturesFromFile() returns with skyIndex.fromApertures(names,apertures), or from an apertures.csv/nameloc.csv with skyIndex.fromFile().'''
+
+    def __init__(self,names,ra,dec):
+        from scipy.spatial import cKDTree
+        self.names = np.asarray(names)
+        self.ra,self.dec = np.atleast_1d(np.asarray(ra,dtype=float)),np.atleast_1d(np.asarray(dec,dtype=float))
+        self.tree = cKDTree(radecToUnit(self.ra,self.dec))
+
+    @classmethod
+    def fromApertures(cls,names,apertures):
+        ra = [aperture.positions.ra.deg for aperture in apertures]
+        dec = [aperture.positions.dec.deg for aperture in apertures]
+        return cls(names,ra,dec)
+
+    @classmethod
+    def fromFile(cls,filepath,nameCol='Name',raCol='RA',decCol='DEC'):
+        from astropy.table import Table
+        catalog = Table.read(filepath)
+        return cls(catalog[nameCol],catalog[raCol],catalog[decCol])
+
+    def match(self,ra,dec,maxSep=5.0):
+        '''Matches each detection (at ra, dec in degrees) to its nearest catalog star that is within maxSep arcsec. If more than one detection lands on the same star, only the closest one is kept.
+        Returns a dictionary with, for each detection, "catalog_index" (-1 for no match) and "separation" (arcsec), and for each catalog star, "detection_index" (-1 if missing), "offset_ra" and "offset_dec" (detection minus catalog, in arcsec on the sky, nan if missing), and "missing".'''
+        vectors = radecToUnit(ra,dec)
+        chord,index = self.tree.query(vectors,k=1,distance_upper_bound=arcsecToChord(maxSep))
+        found = np.isfinite(chord)
+        separation = np.where(found,chordToArcsec(np.where(found,chord,0)),np.inf)
+        index = np.where(found,index,-1)
+        #keep the closest detection for each star: sort by separation, then take the first of each star
+        order = np.argsort(separation,kind='stable')
+        order = order[found[order]]
+        stars,first = np.unique(index[order],return_index=True)
+        keep = order[first]
+        catalog_index = np.full(len(vectors),-1)
+        catalog_index[keep] = stars
+        detection_index = np.full(len(self.names),-1)
+        detection_index[stars] = keep
+        offset_ra = np.full(len(self.names),np.nan)
+        offset_dec = np.full(len(self.names),np.nan)
+        det_ra,det_dec = np.atleast_1d(ra)[keep],np.atleast_1d(dec)[keep]
+        dra = (det_ra - self.ra[stars] + 180) % 360 - 180 #wrap across RA=0
+        offset_ra[stars] = dra*np.cos(np.radians(self.dec[stars]))*3600
+        offset_dec[stars] = (det_dec - self.dec[stars])*3600
+        return {'catalog_index':catalog_index,'separation':np.where(catalog_index >= 0,separation,np.inf),
+                'detection_index':detection_index,'offset_ra':offset_ra,'offset_dec':offset_dec,
+                'missing':detection_index < 0}
+
+    def matchPixels(self,x,y,wcs,maxSep=5.0):
+        '''The same as match(), but for detections given as pixel positions (ie, the x_peak and y_peak columns from find_peaks) in a frame with the given WCS.'''
+        ra,dec = wcs.pixel_to_world_values(np.asarray(x,dtype=float),np.asarray(y,dtype=float))
+        return self.match(ra,dec,maxSep=maxSep)
+
+class matchTracker:
+    '''Keeps the offsets of every catalog star over a run of frames, from the results of skyIndex.match(), so that stars that are drifting away from their catalog position or keep going missing can be flagged.
+    A star is "drifting" if its median offset over the last "window" frames is more than driftLimit arcsec, and "missing" if it wasn't found in more than missingLimit (a fraction) of those frames.'''
+
+    def __init__(self,index,window=20,driftLimit=2.0,missingLimit=0.5):
+        self.index = index
+        self.window,self.driftLimit,self.missingLimit = window,driftLimit,missingLimit
+        self.offsets = deque(maxlen=window) #one (star, 2) array per frame, for just the last "window" frames
+
+    def add(self,matchResult):
+        self.offsets.append(np.column_stack((matchResult['offset_ra'],matchResult['offset_dec'])))
+        return self.flags()
+
+    def flags(self):
+        '''Returns a dictionary with "drifting" and "missing" boolean arrays (one per catalog star), and the "median_offset" (star, 2) in arcsec over the recent frames.'''
+        n = len(self.index.names)
+        if not self.offsets:
+            return {'drifting':np.zeros(n,dtype=bool),'missing':np.zeros(n,dtype=bool),'median_offset':np.full((n,2),np.nan)}
+        recent = np.array(self.offsets) #(frame, star, 2)
+        lost = np.isnan(recent[:,:,0])
+        median_offset = np.full((n,2),np.nan)
+        seen = ~lost.all(axis=0)
+        median_offset[seen] = np.nanmedian(recent[:,seen,:],axis=0)
+        drifting = np.hypot(median_offset[:,0],median_offset[:,1]) > self.driftLimit
+        return {'drifting':np.where(seen,drifting,False),'missing':lost.mean(axis=0) > self.missingLimit,'median_offset':median_offset}
+
+    def driftingNames(self):
+        return [str(name) for name in self.index.names[self.flags()['drifting']]]
+
+    def missingNames(self):
+        return [str(name) for name in self.index.names[self.flags()['missing']]]
+
+#end catalog matching section -------
+
+
+#Star picking section ---------
+#These do the same steps as the StarIDNotebook and radialProfiling notebook (find the peaks, filter them, name them, then
+# measure the FWHM and size the apertures from it), as functions so that they can also be run without a notebook.
+
+def findStars(image,nsigma=10.0,boxSize=11,minPeak=None,maxPeak=None,edge=0.1):
+    '''Finds the peaks in the image that are more than nsigma standard deviations above the (sigma clipped) median and at least (boxSize-1)/2 pixels apart. Peaks below minPeak or above maxPeak (ie, saturated ones) are dropped, as are any within the "edge" fraction of the frame from its sides.
+    Returns the find_peaks table (x_peak | y_peak | peak_value) of the ones that are left.'''
+    from astropy.stats import sigma_clipped_stats
+    from astropy.table import Table
+    from photutils.detection import find_peaks
+    mean,median,std = sigma_clipped_stats(image,sigma=3.0)
+    peaks = find_peaks(image,threshold=median + nsigma*std,box_size=boxSize)
+    if peaks is None: return Table(names=['x_peak','y_peak','peak_value'],dtype=[int,int,float])
+    values = peaks['peak_value'].data
+    keep = np.ones(len(peaks),dtype=bool)
+    if minPeak is not None: keep &= values >= minPeak
+    if maxPeak is not None: keep &= values <= maxPeak
+    ny,nx = np.shape(image)
+    x,y = peaks['x_peak'].data,peaks['y_peak'].data
+    keep &= (x > edge*nx) & (x < nx - edge*nx) & (y > edge*ny) & (y < ny - edge*ny)
+    return peaks[keep]
+
+def pickStars(image,wcs,count=40,targetPeak=None,target=None,namer=None,**findArgs):
+    '''Picks up to "count" stars from findStars() (which is given findArgs), preferring the ones whose peak is closest to targetPeak, or the brightest if it isn't given. They are named by the namer (a charnamer by default) and, if the target's (ra, dec) in degrees is given, it is added on the end as "target".
+    Returns the nameloc table (Name | RA | DEC) that the radial profiling and aperture steps use.'''
+    from astropy.table import Table
+    stars = findStars(image,**findArgs)
+    values = stars['peak_value'].data
+    order = np.argsort(np.abs(values - targetPeak),kind='stable') if targetPeak is not None else np.argsort(-values,kind='stable')
+    stars = stars[order[:count]]
+    if namer is None: namer = charnamer()
+    ra,dec = wcs.pixel_to_world_values(np.asarray(stars['x_peak'],dtype=float),np.asarray(stars['y_peak'],dtype=float))
+    nameloc = Table([namer.names(len(stars)),np.asarray(ra,dtype=float),np.asarray(dec,dtype=float)],names=['Name','RA','DEC'],dtype=[str,float,float])
+    if target is not None: nameloc.add_row({'Name':'target','RA':target[0],'DEC':target[1]})
+    return nameloc
+
+def measureFWHM(image,wcs,ra,dec,radii=np.arange(26)):
+    '''Fits a gaussian to the radial profile of the star at each ra, dec (in degrees) and returns their FWHMs in pixels, with nan for any that couldn't be fit. The (sigma clipped) median sky is taken off first, and each star is centroided before its profile is taken.'''
+    from astropy.stats import sigma_clipped_stats
+    from photutils.centroids import centroid_quadratic
+    from photutils.profiles import RadialProfile
+    image = np.asarray(image,dtype=float)
+    image = image - sigma_clipped_stats(image,sigma=3.0)[1]
+    x,y = wcs.world_to_pixel_values(np.atleast_1d(ra),np.atleast_1d(dec))
+    fwhms = np.full(len(x),np.nan)
+    for s in range(len(x)):
+        try:
+            #centroid on a small stamp around the star, then move back to the full frame's pixels
+            x0,y0 = max(int(np.rint(x[s]))-5,0),max(int(np.rint(y[s]))-5,0)
+            xycen = centroid_quadratic(image[y0:y0+11,x0:x0+11]) + np.array([x0,y0])
+            if not np.all(np.isfinite(xycen)): xycen = (x[s],y[s])
+            fwhms[s] = RadialProfile(image,xycen,radii).gaussian_fwhm
+        except (ValueError,RuntimeError,IndexError):
+            continue
+    return fwhms
+
+def makeApertureTable(nameloc,fwhm,pixscale,r=2,r_in=5,r_out=9):
+    '''Adds the aperture radius and annulus radii to a copy of the nameloc table, as multiples (r, r_in, r_out) of the fwhm (in pixels), converted to arcsec with the pixscale (arcsec per pixel). The result is the apertures table that loadAperturesFromFile() reads.'''
+    apertures = nameloc.copy()
+    arcsec = fwhm*pixscale
+    apertures['r'] = np.full(len(apertures),r*arcsec)
+    apertures['r_in'] = np.full(len(apertures),r_in*arcsec)
+    apertures['r_out'] = np.full(len(apertures),r_out*arcsec)
+    return apertures
+
+def pixelScale(wcs):
+    #the mean size of a pixel on the sky, in arcsec
+    from astropy.wcs.utils import proj_plane_pixel_scales
+    return float(np.mean(proj_plane_pixel_scales(wcs.celestial)))*3600
+
+#end star picking section -------
+
+
 # class starIDInstance:
     
 #     def __init__(self,target_coord,working_dir='ident'):
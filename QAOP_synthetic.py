@@ -0,0 +1,151 @@
+#This module makes synthetic (fake) observing runs, for testing the photometry without any real data and for load
+# testing it at scale. It writes FITS frames that look like the ones that come back from astrometry.net: they have a
+# TAN WCS and a date-obs in the header, stars with a realistic PSF, a sky background (which can have a gradient), and
+# poisson and read noise. A transit from exoModels can be put into the target star, so the whole process can be
+# checked end to end against a known answer.
+#
+#The usual way to use it is:
+#    field = makeField(nstars=100)
+#    generateFrames(dataFilePath+'output/', field, nframes=2000, workers=8, transit={'model':'box','delta':0.99,'l':2,'centre':1.5})
+#which writes output/000.fits... along with an apertures.csv (for photInstance) and a truth.ecsv of the real star fluxes.
+
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    from QAOP_starID import charnamer
+except ModuleNotFoundError:
+    from QAOP.QAOP_starID import charnamer
+
+
+def makeField(nstars=50,shape=(1024,1024),fluxRange=(1e3,1e5),ra=300.0,dec=20.0,pixscale=1.0,rotation=0.0,seed=0,border=30):
+    '''Makes the (unchanging) part of a synthetic observation: the star positions and fluxes, and the WCS. The first star is placed near the centre of the frame and is treated as the target.
+    Fluxes are the total counts of each star (log-uniform over fluxRange), pixscale is in arcsec per pixel and rotation is in degrees.
+    Returns a dictionary that the other functions in this module take as "field".'''
+    rng = np.random.default_rng(seed)
+    ny,nx = shape
+    xs = rng.uniform(border,nx-border,nstars)
+    ys = rng.uniform(border,ny-border,nstars)
+    xs[0],ys[0] = nx/2 + rng.uniform(-10,10), ny/2 + rng.uniform(-10,10)
+    fluxes = np.exp(rng.uniform(np.log(fluxRange[0]),np.log(fluxRange[1]),nstars))
+    theta = np.radians(rotation)
+    scale = pixscale/3600
+    cd = scale*np.array([[-np.cos(theta),np.sin(theta)],[np.sin(theta),np.cos(theta)]])
+    return {'shape':(ny,nx),'x':xs,'y':ys,'flux':fluxes,'names':list(charnamer().names(nstars)),
+            'crval':(ra,dec),'crpix':(nx/2,ny/2),'cd':cd,'pixscale':pixscale}
+
+def fieldWCS(field):
+    from astropy.wcs import WCS
+    wcs = WCS(naxis=2)
+    wcs.wcs.ctype = ['RA---TAN','DEC--TAN']
+    wcs.wcs.crval = field['crval']
+    wcs.wcs.crpix = field['crpix']
+    wcs.wcs.cd = field['cd']
+    return wcs
+
+def psfStamp(dx,dy,fwhm,psf='gaussian',beta=3.0):
+    '''Returns the fraction of a star's flux landing in each pixel, for pixel offsets dx,dy from the star's centre. psf can be 'gaussian' or 'moffat' (with the given beta, smaller is wider wings).'''
+    r2 = dx**2 + dy**2
+    if psf == 'moffat':
+        alpha = fwhm/(2*np.sqrt(2**(1/beta) - 1))
+        return (beta-1)/(np.pi*alpha**2) * (1 + r2/alpha**2)**(-beta)
+    sigma = fwhm/(2*np.sqrt(2*np.log(2)))
+    return np.exp(-r2/(2*sigma**2))/(2*np.pi*sigma**2)
+
+def renderFrame(field,fluxScale=None,fwhm=4.0,psf='gaussian',beta=3.0,sky=300.0,skyGradient=(0.0,0.0),gain=1.0,readNoise=10.0,shift=(0.0,0.0),seed=None,noise=True):
+    '''Draws one frame of the field, in ADU. fluxScale multiplies each star's flux (ie, for a transit), skyGradient is the change in the sky (in ADU) per pixel in x and y, and shift moves all the stars by that many pixels (for pointing drift).
+    The noise is poisson noise on the electrons (so it depends on the gain, in e-/ADU) plus gaussian read noise (in e-).'''
+    rng = np.random.default_rng(seed)
+    ny,nx = field['shape']
+    yy,xx = np.mgrid[0:ny,0:nx]
+    image = sky + skyGradient[0]*(xx - nx/2) + skyGradient[1]*(yy - ny/2)
+    fluxes = field['flux'] if fluxScale is None else field['flux']*fluxScale
+    half = int(np.ceil((8 if psf == 'moffat' else 3)*fwhm))
+    #each star only gets drawn on the small stamp around it rather than over the whole frame
+    for x,y,flux in zip(field['x']+shift[0],field['y']+shift[1],fluxes):
+        x0,x1 = max(int(x)-half,0),min(int(x)+half+1,nx)
+        y0,y1 = max(int(y)-half,0),min(int(y)+half+1,ny)
+        if x0 >= x1 or y0 >= y1: continue
+        image[y0:y1,x0:x1] += flux*psfStamp(xx[y0:y1,x0:x1]-x,yy[y0:y1,x0:x1]-y,fwhm,psf=psf,beta=beta)
+    if noise:
+        electrons = rng.poisson(np.clip(image,0,None)*gain).astype(float)
+        image = (electrons + rng.normal(0,readNoise,image.shape))/gain
+    return image
+
+def transitScale(hours,transit,nstars):
+    '''Works out the flux multiplier for every star at each time (in hours from the first frame), with a shape (time, star). Only the first star (the target) has the transit put in.
+    transit is a dictionary with 'model' ('box', 'trap' or 'limbdark') and that model's parameters from exoModels (delta, l, centre, and w for 'trap'), with times in hours. Note that, as in exoModels, delta is the flux at the bottom of the dip for the box and trap models, but for limbdark it is the depth (Rp/Rs)^2.'''
+    try:
+        import exoModels
+    except ModuleNotFoundError:
+        from QAOP import exoModels
+    scale = np.ones((len(hours),nstars))
+    if transit is None: return scale
+    params = {key:value for key,value in transit.items() if key != 'model'}
+    model = transit.get('model','box')
+    if model == 'trap': scale[:,0] = exoModels.trapDipArr(hours,**params)
+    elif model == 'limbdark': scale[:,0] = exoModels.limbDarkArr(hours,**params)
+    else: scale[:,0] = exoModels.boxDipArr(hours,**params)
+    return scale
+
+def writeFrame(filepath,field,date_obs,exptime=60.0,dtype=np.float32,**renderArgs):
+    '''Renders a frame and writes it, with the field's WCS and the date-obs, exposure time, gain and read noise in the header.'''
+    from astropy.io import fits
+    image = renderFrame(field,**renderArgs)
+    header = fieldWCS(field).to_header()
+    header['DATE-OBS'] = date_obs
+    header['EXPTIME'] = exptime
+    header['GAIN'] = renderArgs.get('gain',1.0)
+    header['RDNOISE'] = renderArgs.get('readNoise',10.0)
+    if np.issubdtype(dtype,np.integer):
+        info = np.iinfo(dtype)
+        image = np.clip(np.round(image),info.min,info.max)
+    fits.PrimaryHDU(image.astype(dtype),header).writeto(filepath,overwrite=True)
+    return filepath
+
+def _writeFrameJob(job):
+    #the process pool can only send one argument, so the job is a tuple
+    filepath,field,date_obs,exptime,dtype,renderArgs = job
+    return writeFrame(filepath,field,date_obs,exptime=exptime,dtype=dtype,**renderArgs)
+
+def writeApertureFile(filepath,field,r=None,r_in=None,r_out=None,fwhm=4.0):
+    '''Writes the apertures.csv (Name | RA | DEC | r | r_in | r_out) for the stars in the field, as loadAperturesFromFile() expects. By default the radii (in arcsec) are 2, 3 and 5 FWHM.'''
+    from astropy.table import Table
+    sky = fieldWCS(field).pixel_to_world(field['x'],field['y'])
+    n = len(field['x'])
+    arcsec = fwhm*field['pixscale']
+    Table({'Name':field['names'],'RA':sky.ra.deg,'DEC':sky.dec.deg,
+           'r':np.full(n,2*arcsec if r is None else r),
+           'r_in':np.full(n,3*arcsec if r_in is None else r_in),
+           'r_out':np.full(n,5*arcsec if r_out is None else r_out)}).write(filepath,overwrite=True)
+    return filepath
+
+def generateFrames(directory,field,nframes=100,start='2023-07-28T22:00:00.000',cadence=60.0,transit=None,drift=(0.0,0.0),workers=None,
+                   fwhm=4.0,psf='gaussian',beta=3.0,sky=300.0,skyGradient=(0.0,0.0),gain=1.0,readNoise=10.0,exptime=60.0,dtype=np.float32,seed=0,
+                   apertureFile='apertures.csv',truthFile='truth.ecsv'):
+    '''Writes nframes frames of the field into directory as 000.fits, 001.fits..., one every "cadence" seconds from start. drift is how far the stars move (in pixels, x and y) per frame, and transit is as in transitScale().
+    The frames are written by a pool of "workers" processes (by default one per cpu; 0 or 1 writes them in this process, which is quicker for a handful of small frames). Each frame gets its own seed, so the output is the same however many workers are used.
+    It also writes the apertures file and a truth table (the time, and the true flux of each star, for every frame) into the directory. Returns the list of frame paths.'''
+    os.makedirs(directory,exist_ok=True)
+    offsets = np.arange(nframes)*cadence
+    dates = np.datetime64(start,'ms') + (offsets*1000).astype('timedelta64[ms]')
+    hours = offsets/3600
+    scale = transitScale(hours,transit,len(field['x']))
+    jobs = []
+    for f in range(nframes):
+        renderArgs = {'fluxScale':scale[f],'fwhm':fwhm,'psf':psf,'beta':beta,'sky':sky,'skyGradient':skyGradient,
+                      'gain':gain,'readNoise':readNoise,'shift':(drift[0]*f,drift[1]*f),'seed':(seed,f)}
+        jobs.append((os.path.join(directory,'{:03d}.fits'.format(f)),field,str(dates[f]),exptime,dtype,renderArgs))
+    if workers is not None and workers <= 1:
+        filepaths = [_writeFrameJob(job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            filepaths = list(pool.map(_writeFrameJob,jobs,chunksize=max(1,nframes//(8*(workers or os.cpu_count() or 1)))))
+    if apertureFile:
+        writeApertureFile(os.path.join(directory,apertureFile),field,fwhm=fwhm)
+    if truthFile:
+        from astropy.table import Table
+        truth = Table([dates.astype(str)]+[field['flux'][s]*scale[:,s] for s in range(len(field['x']))],names=['time']+field['names'])
+        truth.write(os.path.join(directory,truthFile),format='ascii.ecsv',overwrite=True)
+    return filepaths
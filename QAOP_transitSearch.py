@@ -0,0 +1,141 @@
+#This module searches a light curve for transits whose centre isn't known yet, by fitting the box model from exoModels
+# (boxDip: the flux drops from base to delta*base between centre-l/2 and centre+l/2) at every trial centre and duration.
+# Rather than making the model for each trial, the fit is done with cumulative sums of the (weighted) flux: the best box
+# for a given start and end only needs the sum of the flux and of the weights inside it, which is the difference of two
+# cumulative sums. So each duration costs one pass over the trial centres, and the durations are run in parallel.
+#
+#The usual way to use it is:
+#    candidates = searchPhotInstance(inst, target='sA', comparisons=['sB','sC'])
+#    best = candidates[0] #ranked, best first
+#    model = candidateModel(hours, best) #the same as exoModels.boxDipArr(hours, best['delta'], best['l'], best['centre'], best['base'])
+#Times and durations are in whatever units the times are given in (hours since midnight by default for searchPhotInstance).
+
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import exoModels
+    from QAOP_utils import datesToHours, datesToJD
+except ModuleNotFoundError:
+    from QAOP import exoModels
+    from QAOP.QAOP_utils import datesToHours, datesToJD
+
+
+def robustScatter(flux):
+    #the point to point scatter of a light curve, from the median absolute difference of neighbouring points, so that a transit doesn't inflate it
+    if len(flux) < 3: return float(np.std(flux)) or 1.0
+    scatter = 1.4826*np.median(np.abs(np.diff(flux) - np.median(np.diff(flux))))/np.sqrt(2)
+    return scatter if scatter > 0 else float(np.std(flux)) or 1.0
+
+def prepareLightCurve(times,flux,err=None):
+    '''Sorts the light curve by time, drops any points that aren't finite, and works out the cumulative sums of the weights (1/err^2) and of the weighted flux that the search uses. If err isn't given, every point gets the robust point to point scatter as its error.'''
+    times,flux = np.asarray(times,dtype=float),np.asarray(flux,dtype=float)
+    good = np.isfinite(times) & np.isfinite(flux)
+    if err is not None:
+        err = np.asarray(err,dtype=float)
+        good &= np.isfinite(err) & (err > 0)
+    order = np.argsort(times[good],kind='stable')
+    times,flux = times[good][order],flux[good][order]
+    err = np.full(len(flux),robustScatter(flux)) if err is None else err[good][order]
+    weights = 1/err**2
+    return {'times':times,'flux':flux,'err':err,
+            'cumWeight':np.concatenate(([0.0],np.cumsum(weights))),'cumFlux':np.concatenate(([0.0],np.cumsum(weights*flux)))}
+
+def searchDuration(lc,duration,centres,minPoints=3):
+    '''Fits the best box of one duration at each of the trial centres. Returns a dictionary of arrays (one value per centre) of "dchi2" (how much better than a flat line the box fits), "delta" and "base" (as in exoModels.boxDip), "depth" (1 - delta), "depth_err", "snr" and "n_in" (the number of points in the box).
+    Boxes with fewer than minPoints points in or out of them get a dchi2 of 0.'''
+    times = lc['times']
+    #boxDip counts a point as in the box if start < x < end, so the first point in is the first one past start,
+    # and the first point out is the first one at or past end
+    first = np.searchsorted(times,centres - duration/2,side='right')
+    last = np.searchsorted(times,centres + duration/2,side='left')
+    n_in = last - first
+    weightTotal,fluxTotal = lc['cumWeight'][-1],lc['cumFlux'][-1]
+    weightIn = lc['cumWeight'][last] - lc['cumWeight'][first]
+    fluxIn = lc['cumFlux'][last] - lc['cumFlux'][first]
+    weightOut,fluxOut = weightTotal - weightIn,fluxTotal - fluxIn
+    valid = (n_in >= minPoints) & (len(times) - n_in >= minPoints)
+    with np.errstate(divide='ignore',invalid='ignore'):
+        levelIn = np.where(valid,fluxIn/weightIn,np.nan)
+        levelOut = np.where(valid,fluxOut/weightOut,np.nan)
+        levelErr = np.sqrt(1/weightIn + 1/weightOut)
+        dchi2 = np.where(valid,weightIn*weightOut/weightTotal*(levelIn - levelOut)**2,0.0)
+        delta = levelIn/levelOut
+        return {'dchi2':dchi2,'delta':delta,'base':levelOut,'depth':1 - delta,'depth_err':levelErr/np.abs(levelOut),
+                'snr':np.where(valid,(levelOut - levelIn)/levelErr,0.0),'n_in':n_in}
+
+def defaultDurations(times,count=16):
+    #from a few cadences long up to a third of the whole light curve, evenly spaced in log
+    cadence = np.median(np.diff(times)) if len(times) > 1 else 1.0
+    span = times[-1] - times[0] if len(times) > 1 else 1.0
+    shortest = max(3*cadence,span/1000)
+    return np.geomspace(shortest,max(span/3,shortest),count)
+
+def boxPeriodogram(times,flux,err=None,durations=None,centres=None,oversample=3,workers=None,minPoints=3):
+    '''Runs searchDuration() for every trial duration, over the trial centres (by default from the first to the last time, spaced by the shortest duration/oversample), using a pool of "workers" threads.
+    Returns a dictionary with the "centres" and "durations" and, for each of the searchDuration() results, a (duration, centre) array.'''
+    lc = prepareLightCurve(times,flux,err)
+    if len(lc['times']) == 0: raise ValueError("The light curve has no finite points to search")
+    durations = defaultDurations(lc['times']) if durations is None else np.atleast_1d(np.asarray(durations,dtype=float))
+    if centres is None:
+        step = durations.min()/oversample
+        centres = np.arange(lc['times'][0],lc['times'][-1] + step,step)
+    centres = np.asarray(centres,dtype=float)
+    search = lambda duration: searchDuration(lc,duration,centres,minPoints=minPoints)
+    if workers is not None and workers <= 1:
+        results = [search(duration) for duration in durations]
+    else:
+        #numpy lets go of the GIL for the searches and the array maths, so threads are enough and nothing has to be copied
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(search,durations))
+    grid = {'centres':centres,'durations':durations}
+    for key in results[0]:
+        grid[key] = np.array([result[key] for result in results])
+    return grid
+
+def rankCandidates(grid,ncandidates=5,minSNR=0.0):
+    '''Picks out the best "ncandidates" dips from a boxPeriodogram() grid, best (biggest dchi2) first. Once a box is picked, every other trial box that overlaps it is dropped, so the candidates are all different events rather than the same dip at slightly different centres and durations.
+    Each candidate is a dictionary of centre, l, delta and base (which can be passed straight to exoModels.boxDipArr()), along with depth, depth_err, snr, dchi2 and n_in.'''
+    score = np.where((grid['snr'] > minSNR) & (grid['delta'] < 1),grid['dchi2'],0.0)
+    centres,durations = grid['centres'][None,:],grid['durations'][:,None]
+    candidates = []
+    while len(candidates) < ncandidates:
+        d,c = np.unravel_index(np.argmax(score),score.shape)
+        if score[d,c] <= 0: break
+        candidates.append({'centre':float(grid['centres'][c]),'l':float(grid['durations'][d]),'delta':float(grid['delta'][d,c]),
+                           'base':float(grid['base'][d,c]),'depth':float(grid['depth'][d,c]),'depth_err':float(grid['depth_err'][d,c]),
+                           'snr':float(grid['snr'][d,c]),'dchi2':float(grid['dchi2'][d,c]),'n_in':int(grid['n_in'][d,c])})
+        overlaps = np.abs(centres - grid['centres'][c]) < (durations + grid['durations'][d])/2
+        score = np.where(overlaps,0.0,score)
+    return candidates
+
+def boxSearch(times,flux,err=None,durations=None,centres=None,oversample=3,workers=None,ncandidates=5,minPoints=3,minSNR=0.0):
+    '''Searches the light curve (relative flux, so a transit is a dip) for box shaped transits, and returns the ranked list of candidates from rankCandidates().'''
+    grid = boxPeriodogram(times,flux,err=err,durations=durations,centres=centres,oversample=oversample,workers=workers,minPoints=minPoints)
+    return rankCandidates(grid,ncandidates=ncandidates,minSNR=minSNR)
+
+def candidateModel(times,candidate):
+    #the box model for a candidate, from exoModels
+    return exoModels.boxDipArr(times,candidate['delta'],candidate['l'],candidate['centre'],candidate['base'])
+
+def differentialFlux(values,names,target,comparisons):
+    '''Takes the (time, source, [aperture_sum, aperture_sum_err]) array from photInstance.masterAsArray() and returns the flux of the target relative to the summed comparison stars, normalised to a median of 1, along with its error.'''
+    names = list(names)
+    t = names.index(target)
+    c = [names.index(name) for name in comparisons]
+    fluxV,errV = values[:,t,0],values[:,t,1]
+    fluxC,errC = values[:,c,0].sum(axis=1),np.sqrt((values[:,c,1]**2).sum(axis=1))
+    ratio = fluxV/fluxC
+    err = np.abs(ratio)*np.sqrt((errV/fluxV)**2 + (errC/fluxC)**2)
+    scale = np.nanmedian(ratio)
+    return ratio/scale,err/scale
+
+def searchPhotInstance(inst,target,comparisons,unit='hours',**searchArgs):
+    '''Searches the target's differential light curve (against the summed comparisons) from a photInstance's master table. The times are in hours since midnight of the first frame (unit='hours') or in JD (unit='jd'), and the durations should be given in the same unit. Any other arguments are passed to boxSearch().
+    The aperture_sum_err values are used as the errors if the table has them, otherwise the scatter of the light curve is.'''
+    dates,values = inst.masterAsArray(['aperture_sum','aperture_sum_err'])
+    times = datesToJD(dates) if unit == 'jd' else datesToHours(dates)
+    flux,err = differentialFlux(values,inst.names,target,comparisons)
+    if np.isfinite(err).any(): err = np.where(np.isfinite(err),err,np.nanmedian(err)) #ie, rows from before the errors were kept
+    else: err = None
+    return boxSearch(times,flux,err=err,**searchArgs)
@@ -40,6 +40,10 @@ def diffMag(fluxV,fluxC):
 def mag(flux):
     return -2.5 * np.log10(flux)
 
+def diffMagErr(fluxV,errV,fluxC,errC):
+    #the uncertainty on diffMag(fluxV,fluxC), from the uncertainties on the two fluxes (ie, aperture_sum_err)
+    return (2.5/np.log(10)) * np.sqrt((errV/fluxV)**2 + (errC/fluxC)**2)
+
 
 #iTelescope date conversions.
 def getTimeFromDate(dateStr):
@@ -52,10 +56,53 @@ def getTimeFromDate(dateStr):
     time = hour + (minute + (second/60))/60
     return time
 
+#Vectorized versions of the above. These parse a whole column of date-obs strings at once using numpy's datetime64
+# (which does the string parsing in C), and they keep the date so that nights crossing midnight UTC stay continuous.
+UNIX_EPOCH_JD = 2440587.5 #the julian date of 1970-01-01T00:00:00, which is where datetime64 counts from
+NS_PER_DAY = 86400 * 10**9
+
+def datesToDatetime64(dates):
+    '''Converts a list/array/column of ISO-8601 date strings (YYYY-MM-DD'T'HH:MM:SS.SSS, as written in the 'date-obs' header) into a numpy datetime64[ns] array in one call.'''
+    return np.asarray(dates,dtype=str).astype('datetime64[ns]')
+
+def datesToJD(dates):
+    '''Returns the Julian Date (UTC) of each of the given date strings as a float64 array.'''
+    ns = datesToDatetime64(dates).astype('int64')
+    #split into whole days and the fraction of a day before going to floats, so we don't lose precision on the big JD number
+    days = ns // NS_PER_DAY
+    dayFraction = (ns - days*NS_PER_DAY)/NS_PER_DAY
+    return (UNIX_EPOCH_JD + days) + dayFraction
+
+def datesToMJD(dates):
+    return datesToJD(dates) - 2400000.5
+
+def datesToHours(dates,reference=None):
+    '''Returns the time of each date string in hours, measured from midnight (UTC) of the reference date. By default the reference is the date of the first timestamp, so for a night that crosses midnight the times carry on past 24 instead of wrapping back to 0.
+    A different reference can be given as a date string (ie, '2023-07-28') or a datetime64.'''
+    stamps = datesToDatetime64(dates)
+    if reference is None:
+        if len(stamps) == 0: return np.zeros(0)
+        reference = stamps[0]
+    midnight = np.datetime64(reference,'D')
+    return (stamps - midnight)/np.timedelta64(1,'h')
+
+def datesToBJD(dates,ra,dec,location=None):
+    '''Returns the Barycentric Julian Date (TDB) of each of the date strings, for a target at the given ra and dec (in degrees).
+    The light travel time correction needs astropy, so it is imported here rather than at the top of the module. The location should be an astropy EarthLocation for the observatory; if it isn't given the correction is done from the geocentre, which is good to ~20ms.'''
+    from astropy.time import Time
+    from astropy.coordinates import SkyCoord, EarthLocation
+    import astropy.units as u
+    if location is None:
+        location = EarthLocation.from_geocentric(0,0,0,unit=u.m)
+    times = Time(datesToJD(dates),format='jd',scale='utc',location=location)
+    target = SkyCoord(ra=ra*u.deg,dec=dec*u.deg)
+    return (times.tdb + times.light_travel_time(target)).jd
+
 #this is a useful method, idk where to put it
-def genTimesFromTable(table,debug=False):
-    times = np.zeros(len(table))
-    for d,date in enumerate(table['time']):
-        if debug: print(d,date)
-        times[d] = getTimeFromDate(date)
-    return times
\ No newline at end of file
+def genTimesFromTable(table,debug=False,unit='hours'):
+    '''Returns the times in the 'time' column of a table (such as those exported by photInstance) as a float array. By default these are in hours since midnight of the first frame's date, but unit='jd' or unit='mjd' can be given instead.'''
+    dates = np.asarray(table['time'],dtype=str)
+    if debug: print(dates)
+    if unit == 'jd': return datesToJD(dates)
+    if unit == 'mjd': return datesToMJD(dates)
+    return datesToHours(dates)
\ No newline at end of file
@@ -0,0 +1,197 @@
+#This is the command line version of the reduction, for running it without the notebooks (ie, on a cluster or from cron).
+# With the QAOP folder on the path (run it from the folder that contains QAOP) it is used as:
+#
+#    python -m QAOP --config QAOP/ pick output/001.fits --out nameloc.csv --target 303.38 65.16
+#    python -m QAOP --config QAOP/ fwhm output/001.fits --stars nameloc.csv --out apertures.csv
+#    python -m QAOP --config QAOP/ phot 'output/*.fits' --apertures apertures.csv --results photometry --workers 8
+#    python -m QAOP --config QAOP/ export --apertures apertures.csv --results photometry --format simple npz
+#
+#If --config is given, relative paths are taken from the data directory in that config file (the same as photInstance
+# does), otherwise from the current directory. --timing writes a JSON summary of how long the command took (and, for
+# phot, how long each stage of the photometry took) to a file, or to stdout with --timing -.
+
+import os
+import sys
+import glob
+import json
+import time
+import argparse
+import numpy as np
+
+try:
+    from QAOP_utils import readConfigFile
+    import QAOP_photometry as phot
+    import QAOP_pipeline as pipeline
+    import QAOP_starID as starID
+except ModuleNotFoundError:
+    from QAOP.QAOP_utils import readConfigFile
+    import QAOP.QAOP_photometry as phot
+    import QAOP.QAOP_pipeline as pipeline
+    import QAOP.QAOP_starID as starID
+
+
+def dataDirectory(configPath):
+    '''Returns the data directory from the config file at configPath (either the config.txt itself or the folder it is in), or '' if no config was given.'''
+    if configPath is None: return ''
+    if os.path.isfile(configPath): configPath = os.path.dirname(configPath)
+    codeFilePath,dataFilePath,errormsg = readConfigFile(os.path.join(configPath,''))
+    if isinstance(errormsg,Exception): raise SystemExit("Couldn't read the config file in "+configPath+": "+str(errormsg))
+    return dataFilePath
+
+def expandFrames(patterns,base=''):
+    #every file matching any of the patterns, in name order and without repeats
+    filepaths = set()
+    for pattern in patterns:
+        filepaths.update(glob.glob(os.path.join(base,pattern)))
+    return sorted(filepaths)
+
+def showProgress(done,total,start,quiet=False):
+    if quiet: return
+    elapsed = time.perf_counter() - start
+    rate = done/elapsed if elapsed > 0 else 0.0
+    eta = (total - done)/rate if rate > 0 else 0.0
+    sys.stderr.write('\r{}/{} frames  {:.2f} frames/s  {:.0f}s left '.format(done,total,rate,eta))
+    if done == total: sys.stderr.write('\n')
+    sys.stderr.flush()
+
+def loadImage(filepath):
+    image,wcs,img_time,detector = phot.loadFrame(filepath)
+    return np.asarray(image,dtype=float),wcs
+
+
+#Commands ---------
+#Each takes the parsed arguments and the data directory, and returns a dictionary of what it did for the timing output.
+
+def cmdPick(args,base):
+    image,wcs = loadImage(os.path.join(base,args.image))
+    nameloc = starID.pickStars(image,wcs,count=args.count,targetPeak=args.target_peak,target=args.target,
+                               nsigma=args.nsigma,boxSize=args.box,minPeak=args.min_peak,maxPeak=args.max_peak,edge=args.edge)
+    nameloc.write(os.path.join(base,args.out),overwrite=True)
+    if not args.quiet: print(len(nameloc),'stars written to',os.path.join(base,args.out))
+    return {'stars':len(nameloc)}
+
+def cmdFWHM(args,base):
+    from astropy.table import Table
+    image,wcs = loadImage(os.path.join(base,args.image))
+    nameloc = Table.read(os.path.join(base,args.stars))
+    stars = nameloc[nameloc['Name'] != 'target'] #the target was added by hand, so it isn't necessarily on a peak
+    fwhms = starID.measureFWHM(image,wcs,stars['RA'],stars['DEC'],radii=np.arange(args.radii+1))
+    fwhm = float(np.nanmedian(fwhms)) if np.isfinite(fwhms).any() else float('nan')
+    pixscale = starID.pixelScale(wcs)
+    if not args.quiet:
+        print('FWHM: {:.3f} pixels ({:.3f} arcsec), median of {} stars'.format(fwhm,fwhm*pixscale,int(np.isfinite(fwhms).sum())))
+    if args.out:
+        if not np.isfinite(fwhm): raise SystemExit("None of the stars' profiles could be fit, so no apertures were written")
+        starID.makeApertureTable(nameloc,fwhm,pixscale,r=args.r,r_in=args.r_in,r_out=args.r_out).write(os.path.join(base,args.out),format='csv',overwrite=True)
+    return {'stars':len(stars),'fwhm_px':fwhm,'fwhm_arcsec':fwhm*pixscale,'pixscale':pixscale}
+
+def makeCalibration(args,base):
+    if not (args.bias or args.dark or args.flat): return None
+    try:
+        from QAOP_calibration import calibrator
+    except ModuleNotFoundError:
+        from QAOP.QAOP_calibration import calibrator
+    return calibrator.fromFiles(expandFrames(args.bias,base),expandFrames(args.dark,base),expandFrames(args.flat,base),
+                                cacheDir=os.path.join(base,args.results,'calibration'),cutout=args.cutout)
+
+def cmdPhot(args,base):
+    resultDir = os.path.join(base,args.results)
+    os.makedirs(resultDir,exist_ok=True)
+    inst = phot.photInstance(os.path.join(base,args.apertures),resultDir,disableConfig=True,stats=phot.photStats(),
+                             recenterBox=args.recenter,calibration=makeCalibration(args,base))
+    filepaths = expandFrames(args.frames,base)
+    if not args.no_resume:
+        done = set(inst.processedFiles())
+        filepaths = [filepath for filepath in filepaths if filepath not in done]
+    workers = args.workers if args.workers else os.cpu_count() or 1
+    start = time.perf_counter()
+    if workers > 1 and len(filepaths) > 1:
+        records = pipeline.measureFilesParallel(inst,filepaths,workers=workers,checkpointEvery=args.checkpoint)
+    else:
+        records = pipeline.measureFrames(inst,pipeline.prefetch(pipeline.iterFrames(filepaths,stats=inst.stats)),checkpointEvery=args.checkpoint)
+    showProgress(0,len(filepaths),start,args.quiet or not filepaths)
+    for done,record in enumerate(records,1):
+        showProgress(done,len(filepaths),start,args.quiet)
+    inst.saveMaster()
+    elapsed = time.perf_counter() - start
+    return {'frames':len(filepaths),'workers':workers,'frames_per_s':len(filepaths)/elapsed if elapsed > 0 else 0.0,
+            'photometry':inst.stats.summary()}
+
+def cmdExport(args,base):
+    resultDir = os.path.join(base,args.results)
+    inst = phot.photInstance(os.path.join(base,args.apertures),resultDir,disableConfig=True)
+    exporters = {'tables':inst.exportMasterAsTables,'simple':inst.exportMasterAsSimple,'values':inst.exportMasterAsValues,
+                 'npz':inst.exportMasterAsNPZ,'hdf5':inst.exportMasterAsHDF5,'parquet':inst.exportMasterAsParquet}
+    seconds = {}
+    for fmt in args.format:
+        start = time.perf_counter()
+        exporters[fmt]()
+        seconds[fmt] = time.perf_counter() - start
+        if not args.quiet: print('exported',fmt,'to',resultDir)
+    return {'rows':len(inst.master_tab),'export_s':seconds}
+
+
+def makeParser():
+    parser = argparse.ArgumentParser(prog='python -m QAOP',description='Run the QAOP reduction steps from the command line.')
+    parser.add_argument('--config',help='The config.txt (or the folder it is in) to take the data directory from; relative paths are then inside that directory')
+    parser.add_argument('--timing',help='Write a JSON summary of the timing to this file ("-" for stdout)')
+    parser.add_argument('--quiet',action='store_true',help="Don't print progress or results")
+    commands = parser.add_subparsers(dest='command',required=True)
+
+    pick = commands.add_parser('pick',help='Find and name the stars in a frame, writing the nameloc table (Name | RA | DEC)')
+    pick.add_argument('image',help='A plate solved frame')
+    pick.add_argument('--out',default='nameloc.csv')
+    pick.add_argument('--count',type=int,default=40,help='The most stars to keep')
+    pick.add_argument('--nsigma',type=float,default=10.0,help='How far above the sky (in standard deviations) a peak has to be')
+    pick.add_argument('--box',type=int,default=11,help='The box size peaks have to be separated by')
+    pick.add_argument('--min-peak',type=float)
+    pick.add_argument('--max-peak',type=float,help='Drop peaks brighter than this (ie, saturated ones)')
+    pick.add_argument('--edge',type=float,default=0.1,help='Drop peaks within this fraction of the frame from the sides')
+    pick.add_argument('--target-peak',type=float,help="Prefer the stars whose peak is closest to this (ie, the target's peak)")
+    pick.add_argument('--target',type=float,nargs=2,metavar=('RA','DEC'),help='Add the target at this RA and DEC (degrees)')
+
+    fwhm = commands.add_parser('fwhm',help='Measure the FWHM of the stars in a frame, and optionally write the apertures table')
+    fwhm.add_argument('image',help='A plate solved frame')
+    fwhm.add_argument('--stars',default='nameloc.csv',help='The nameloc table from pick')
+    fwhm.add_argument('--out',help='Write the apertures table (Name | RA | DEC | r | r_in | r_out) here')
+    fwhm.add_argument('--radii',type=int,default=25,help='How far out (in pixels) to take the radial profiles')
+    fwhm.add_argument('--r',type=float,default=2,help='Aperture radius, in FWHM')
+    fwhm.add_argument('--r-in',type=float,default=5,help='Annulus inner radius, in FWHM')
+    fwhm.add_argument('--r-out',type=float,default=9,help='Annulus outer radius, in FWHM')
+
+    photometry = commands.add_parser('phot',help='Do the photometry on every frame matching the patterns, adding them to the master table')
+    photometry.add_argument('frames',nargs='+',help="Frame paths or glob patterns (quote them, ie 'output/*.fits')")
+    photometry.add_argument('--apertures',default='apertures.csv')
+    photometry.add_argument('--results',default='photometry',help='The results directory for the master table and log')
+    photometry.add_argument('--workers',type=int,default=1,help='Number of processes (0 for one per cpu)')
+    photometry.add_argument('--checkpoint',type=int,default=50,help='Save the master table every this many frames')
+    photometry.add_argument('--recenter',type=int,help='Recenter the apertures on each frame with stamps of this size')
+    photometry.add_argument('--no-resume',action='store_true',help='Redo frames that are already in the master table')
+    photometry.add_argument('--bias',nargs='*',default=[],help='Bias frames (paths or patterns)')
+    photometry.add_argument('--dark',nargs='*',default=[],help='Dark frames')
+    photometry.add_argument('--flat',nargs='*',default=[],help='Flat frames')
+    photometry.add_argument('--cutout',action='store_true',help='Only calibrate the boxes around the stars')
+
+    export = commands.add_parser('export',help='Export the master table')
+    export.add_argument('--apertures',default='apertures.csv')
+    export.add_argument('--results',default='photometry')
+    export.add_argument('--format',nargs='+',default=['simple'],choices=['tables','simple','values','npz','hdf5','parquet'])
+    return parser
+
+def main(argv=None):
+    args = makeParser().parse_args(argv)
+    start = time.perf_counter()
+    base = dataDirectory(args.config)
+    command = {'pick':cmdPick,'fwhm':cmdFWHM,'phot':cmdPhot,'export':cmdExport}[args.command]
+    timing = {'command':args.command}
+    timing.update(command(args,base))
+    timing['wall_s'] = time.perf_counter() - start
+    if args.timing == '-':
+        print(json.dumps(timing))
+    elif args.timing:
+        with open(args.timing,'w') as out: json.dump(timing,out,indent=1)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -294,6 +294,7 @@ if __name__ == '__main__':
     parser.add_option('--album', type=str, help='Add image to album with given title string')
     parser.add_option('--sdss', dest='sdss_wcs', nargs=2, help='Plot SDSS image for the given WCS file; write plot to given PNG filename')
     parser.add_option('--galex', dest='galex_wcs', nargs=2, help='Plot GALEX image for the given WCS file; write plot to given PNG filename')
+    parser.add_option('--ledger', dest='ledger', help='Keep the submission and job ids of the --upload file in this ledger file (see QAOP_astrometry), so that an interrupted --wait picks up where it left off when run again')
     parser.add_option('--jobid', '-i', dest='solved_id', type=int,help='retrieve result for jobId instead of submitting new image')
     parser.add_option('--substatus', '-s', dest='sub_id', help='Get status of a submission')
     parser.add_option('--jobstatus', '-j', dest='job_id', help='Get status of a job')
@@ -340,6 +341,25 @@ if __name__ == '__main__':
     c = Client(**args)
     c.login(opt.apikey)
 
+    ledger = None
+    if opt.ledger:
+        try:
+            from QAOP_astrometry import jobLedger
+        except ModuleNotFoundError:
+            from QAOP.QAOP_astrometry import jobLedger
+        ledger = jobLedger(opt.ledger) if opt.upload else None
+        if ledger is None: print('--ledger only keeps track of --upload files, so it is ignored')
+        ledger_file = opt.upload
+        entry = ledger.entries.get(opt.upload) if ledger is not None else None
+        if entry is not None:
+            # already uploaded before a restart; carry on with its ids instead of uploading it again
+            print('Resuming', opt.upload, 'from the ledger:', entry)
+            opt.sub_id = entry.get('subid')
+            if opt.solved_id is None: opt.solved_id = entry.get('jobid')
+            opt.upload = None
+            if opt.wcs or opt.kmz or opt.newfits or opt.corr or opt.annotate:
+                opt.wait = True
+
     if opt.upload or opt.upload_url or opt.upload_xy:
         if opt.wcs or opt.kmz or opt.newfits or opt.corr or opt.annotate:
             opt.wait = True
@@ -388,6 +408,8 @@ if __name__ == '__main__':
             sys.exit(-1)
 
         opt.sub_id = upres['subid']
+        if ledger is not None and opt.upload:
+            ledger.record(opt.upload, 'uploaded', subid=opt.sub_id)
 
     if opt.wait:
         if opt.solved_id is None:
@@ -395,6 +417,8 @@ if __name__ == '__main__':
                 print("Can't --wait without a submission id or job id!")
                 sys.exit(-1)
 
+            # wait 2s between checks at first, doubling up to a minute, rather than a fixed 5s
+            delay = 2
             while True:
                 stat = c.sub_status(opt.sub_id, justdict=True)
                 print('Got status:', stat)
@@ -406,19 +430,28 @@ if __name__ == '__main__':
                     if j is not None:
                         print('Selecting job id', j)
                         opt.solved_id = j
+                        if ledger is not None:
+                            ledger.record(ledger_file, 'solving', subid=opt.sub_id, jobid=j)
                         break
-                time.sleep(5)
+                time.sleep(delay)
+                delay = min(delay*2, 60)
 
+        delay = 2
         while True:
             stat = c.job_status(opt.solved_id, justdict=True)
             print('Got job status:', stat)
             if stat.get('status','') in ['success']:
                 success = (stat['status'] == 'success')
+                if ledger is not None:
+                    ledger.record(ledger_file, 'solved', subid=opt.sub_id, jobid=opt.solved_id)
                 break
             elif stat.get('status','') in ['failure']:
                 print("Image solving failed")
+                if ledger is not None:
+                    ledger.record(ledger_file, 'failed', subid=opt.sub_id, jobid=opt.solved_id)
                 sys.exit(-1)
-            time.sleep(5)
+            time.sleep(delay)
+            delay = min(delay*2, 60)
 
     if opt.solved_id:
         # we have a jobId for retrieving results
@@ -445,6 +478,8 @@ if __name__ == '__main__':
             w.write(txt)
             w.close()
             print('Wrote to', fn)
+            if ledger is not None and fn == opt.newfits:
+                ledger.record(ledger_file, 'downloaded', subid=opt.sub_id, jobid=opt.solved_id, output=fn)
 
         if opt.annotate:
             result = c.annotate_data(opt.solved_id)
@@ -2,8 +2,10 @@
 #They are defined in three levels of complexity, although the third one is complex enough I haven't actually done it yet.
 
 import numpy as np
-import limbDark
-from scipy.integrate import quad
+try:
+    import limbDark
+except ModuleNotFoundError:
+    from QAOP import limbDark
 
 #The first is a box fit.
 def boxDip(x,delta,l,centre,base=1):
@@ -34,10 +36,12 @@ def trapDip(x,delta,l,w,centre,base=1):
     return 0
 
 def boxDipArr(times,delta,l,centre,base=1):
-    results = np.zeros(len(times))
-    for i,t in enumerate(times):
-        results[i] = boxDip(t,delta,l,centre,base)
-    return results
+    #the same as calling boxDip() on each time, but done on the whole array at once
+    times = np.asarray(times,dtype=float)
+    start = centre - (l/2)
+    end = centre + (l/2)
+    outside = (times <= start) | (times >= end)
+    return np.where(outside,base,delta*base).astype(float)
 
 def trapDipArr(times,delta,l,w,centre,base=1):
     results = np.zeros(len(times))
@@ -1,6 +1,5 @@
 import numpy as np
-import matplotlib.pyplot as plt
-from scipy.integrate import quad
+#scipy is only needed for the integral in transFlux(), so it is imported there (matplotlib was never used here)
 
 ''' 
 This module implements the limb darkening model of exoplanets transits 
@@ -52,6 +51,7 @@ def mu(r):
     return (1-(r**2))**(1/2)
 
 def transFlux(z,p=0.1,C=c):
+    from scipy.integrate import quad
     if z > 1+p:
         return 1
     if z < 1-p: